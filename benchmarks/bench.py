@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+Measures throughput and latency of the common database operations on a
+synthetic data set, and writes the results as JSON so that runs can be
+compared:
+
+    $ python benchmarks/bench.py --size 10000 --keys mixed -o after.json
+    $ python benchmarks/bench.py --size 10000 --keys mixed --compare before.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lindh import jsondb  # noqa: E402
+
+
+KEYS = ('int', 'string', 'tuple', 'mixed')
+STORAGES = {
+    'file': None,
+    'log': jsondb.LogStorage,
+}
+
+
+def make_key(rnd, keys, cardinality):
+    n = rnd.randrange(cardinality)
+    if keys == 'int':
+        return n
+    if keys == 'string':
+        return 'key-%06i' % n
+    if keys == 'tuple':
+        return ('group-%03i' % (n % 100), n, rnd.random() < 0.5)
+    return rnd.choice([
+        None,
+        n,
+        n / 7,
+        'key-%06i' % n,
+        ('group-%03i' % (n % 100), n),
+        ['list', n],
+    ])
+
+
+def make_doc(rnd, keys, cardinality):
+    return {
+        'key': make_key(rnd, keys, cardinality),
+        'group': rnd.randrange(100),
+        'amount': rnd.randrange(1000),
+        'text': ''.join(rnd.choice('abcdefghij ') for _ in range(rnd.randrange(20, 200))),
+    }
+
+
+# Module level, so that a parallel reindex can send them to other processes
+def by_key(o):
+    return o['key'], o['amount']
+
+
+def by_group(o):
+    return o['group'], o['amount']
+
+
+def sum_values(keys, values, rereduce):
+    return sum(values)
+
+
+class Timer:
+    def __init__(self):
+        self.latencies = []
+        self.started = time.perf_counter()
+        self.total = None
+
+    def measure(self, fn, *args, **kwargs):
+        t0 = time.perf_counter()
+        result = fn(*args, **kwargs)
+        self.latencies.append(time.perf_counter() - t0)
+        return result
+
+    def stop(self):
+        self.total = time.perf_counter() - self.started
+        return self
+
+    def result(self, count=None):
+        count = count if count is not None else len(self.latencies)
+        result = {
+            'count': count,
+            'seconds': self.total,
+            'ops_per_sec': count / self.total if self.total else None,
+        }
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            result['p50_ms'] = percentile(latencies, 50) * 1000
+            result['p99_ms'] = percentile(latencies, 99) * 1000
+        return result
+
+
+def percentile(ordered, p):
+    index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run(args):
+    rnd = random.Random(args.seed)
+    root = tempfile.mkdtemp(prefix='jsondb-bench-')
+    results = {}
+    try:
+        db = jsondb.Database(root, storage=STORAGES[args.storage])
+        db.define('by_key', by_key)
+        db.define('by_group', by_group, sum_values)
+        cardinality = max(1, int(args.size * args.cardinality))
+        docs = [make_doc(rnd, args.keys, cardinality) for _ in range(args.size)]
+
+        timer = Timer()
+        saved = [timer.measure(db.save, doc) for doc in docs]
+        results['save'] = timer.stop().result()
+
+        ids = [o['_id'] for o in saved]
+        timer = Timer()
+        for _ in range(args.operations):
+            timer.measure(db.get, rnd.choice(ids))
+        results['get'] = timer.stop().result()
+
+        timer = Timer()
+        rows = 0
+        for _ in range(args.operations):
+            first, last = sorted((rnd.choice(saved)['key'] for _ in range(2)), key=jsondb.collate)
+            rows += len(timer.measure(
+                lambda: list(db.view('by_key', startkey=first, endkey=last, limit=args.limit))))
+        results['view_range'] = timer.stop().result()
+        results['view_range']['rows'] = rows
+
+        timer = Timer()
+        for _ in range(args.operations):
+            first, last = sorted((rnd.choice(saved)['key'] for _ in range(2)), key=jsondb.collate)
+            timer.measure(lambda: list(db.view(
+                'by_key', startkey=first, endkey=last, limit=args.limit, include_docs=True)))
+        results['view_include_docs'] = timer.stop().result()
+
+        timer = Timer()
+        for i in range(args.operations):
+            # every other query follows a write, which drops part of the cache
+            if i % 2:
+                o = db.get(rnd.choice(ids))
+                o['amount'] += 1
+                db.save(o)
+            timer.measure(lambda: list(db.view('by_group', group=True)))
+        results['reduce_group'] = timer.stop().result()
+
+        for processes in sorted({1, args.processes}):
+            timer = Timer()
+            timer.measure(db.reindex, processes=processes)
+            results['reindex_cold' if processes == 1 else 'reindex_cold_%i' % processes] = \
+                timer.stop().result(count=args.size)
+
+        timer = Timer()
+        for id in rnd.sample(ids, min(args.operations, len(ids))):
+            timer.measure(db.delete, id)
+        results['delete'] = timer.stop().result()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    return {
+        'settings': vars(args),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'jsondb': jsondb.__version__,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+
+
+def compare(report, previous):
+    print('%-20s %14s %14s %8s' % ('', 'before', 'now', 'change'))
+    for name, result in report['results'].items():
+        before = previous['results'].get(name, {}).get('ops_per_sec')
+        now = result['ops_per_sec']
+        if before and now:
+            print('%-20s %12.1f/s %12.1f/s %+7.1f%%' % (name, before, now, (now / before - 1) * 100))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--size', type=int, default=5000, help='number of documents')
+    parser.add_argument('--operations', type=int, default=500, help='number of reads, queries and deletes')
+    parser.add_argument('--keys', choices=KEYS, default='mixed', help='type of the view keys')
+    parser.add_argument('--cardinality', type=float, default=0.1,
+                        help='number of distinct keys, as a share of the documents')
+    parser.add_argument('--limit', type=int, default=100, help='page size of range queries')
+    parser.add_argument('--storage', choices=sorted(STORAGES.keys()), default='file')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1,
+                        help='processes for the parallel reindex')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('-o', '--output', help='file to write the results to')
+    parser.add_argument('--compare', help='results of an earlier run to compare with')
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,53 +1,407 @@
 #!/usr/bin/env python3
 
 import os
+import re
+import bisect
 import json
-import threading
 import shutil
 import logging
 import blist
 import hashlib
+import pickle
+import itertools
+import operator
+import struct
+import contextlib
+import functools
+import multiprocessing
+import threading
+import collections
+import time
+from concurrent.futures import ThreadPoolExecutor
+from .storage import FileStorage, LogStorage
+from .lock import ReadWriteLock, FileLock
+from .wal import WriteAheadLog
+from .cache import LRUCache, copy
+from .metrics import Metrics, NULL_METRICS
+from .codec import encoder, DEFAULT as DEFAULT_CODEC
+from .frozen import FrozenIndex, write_frozen
+from .index import FieldIndex
 
 
 __version__ = '0.2.0'
 __author__ = 'Johan Egneblad <johan@egneblad.com>'
-__all__ = ['Database', 'Conflict']
+__all__ = ['Database', 'Conflict', 'FileStorage', 'LogStorage']
 
 
 class Database:
-    def __init__(self, root=None, id_generator=None, filename_hasher=None, logger=None):
+    def __init__(self, root=None, id_generator=None, filename_hasher=None, logger=None,
+                 storage=None, multiprocess=False, durability=None,
+                 cache_size=None, cache_bytes=None, reindex_processes=None,
+                 prefetch_threads=4, view_build='eager', metrics=None, codec=None):
         if root is None:
             raise ValueError('root cannot be None')
         self.logger = logger or logging.getLogger('jsondb')
         self.logger.debug('Initializing JsonDB at %s', root)
         self.root = root
+        if metrics is True:
+            metrics = Metrics()
+        self.metrics = metrics or NULL_METRICS
         self._id_generator = id_generator or self._default_id_generator
-        self._filename_hasher = filename_hasher or self._default_filename_hasher
+        if storage is None:
+            self._storage = FileStorage(self.root, filename_hasher=filename_hasher)
+        else:
+            self._storage = storage(self.root)
+        self._storage.metrics = self.metrics
+        self._codec_file = os.path.join(self.root, 'codec')
+        self._set_codec(codec)
         self._view_map_function = dict()
         self._view_reduce_function = dict()
         self._view_data = dict()
         self._id_view_cache = dict()
-        self._object_folder = os.path.join(self.root, 'objects')
+        self._view_reduction = dict()
+        self._view_fingerprint = dict()
+        self._view_checkpoint_seq = dict()
+        self._caught_up = set()
+        self._view_folder = os.path.join(self.root, 'views')
+        self._indexes_file = os.path.join(self.root, 'indexes')
         self._id_counter_file = os.path.join(self.root, 'id_counter')
-        self._lock = threading.Lock()
+        self._changes_file = os.path.join(self.root, 'changes')
+        self._wal_file = os.path.join(self.root, 'wal')
+        self._durability = durability
+        self._reindex_processes = reindex_processes
+        self._prefetch_threads = prefetch_threads
+        self._prefetch_pool = None
+        self._prefetch_mutex = threading.Lock()
+        self._changed = threading.Condition(threading.Lock())
+        self._all_docs_mutex = threading.Lock()
+        if view_build not in VIEW_BUILDS:
+            raise ValueError('view_build must be one of ' + ', '.join(VIEW_BUILDS))
+        self._view_build = view_build
+        self._view_builds = dict()
+        self._build_mutex = threading.Lock()
+        if cache_size is not None or cache_bytes is not None:
+            self._cache = LRUCache(maxsize=cache_size, maxbytes=cache_bytes)
+        else:
+            self._cache = None
+        self._lock = ReadWriteLock()
+        self._version = 0
+        self._closed = False
+        if multiprocess:
+            if not isinstance(self._storage, FileStorage):
+                raise ValueError('multiprocess needs the default FileStorage')
+            if durability is not None:
+                raise ValueError('multiprocess can not be combined with durability')
+            self._file_lock = FileLock(os.path.join(self.root, 'lock'))
+        else:
+            self._file_lock = None
         self._setup()
+        self._indexes = self._read_indexes()
+        if self._indexes:
+            self.define_many([(name, FieldIndex(fields)) for name, fields in self._indexes.items()])
+
+    def close(self):
+        # The views changed since their checkpoints are saved and the
+        # documents synced and the write-ahead log emptied, so that opening
+        # the database again has nothing to catch up or replay
+        self.logger.debug('Closing JsonDB at %s', self.root)
+        if self._closed:
+            return
+        self.checkpoint(views=[name for name in list(self._view_data.keys())
+                               if self._view_checkpoint_seq.get(name) != self._update_seq])
+        with self._lock:
+            if self._closed:
+                return
+            if self._wal is not None:
+                self._storage.sync()
+                self._wal.truncate()
+            self._close()
 
     def destroy(self):
         self.logger.debug('Destroying JsonDB at %s', self.root)
         with self._lock:
+            self._close()
             if self.root:
                 shutil.rmtree(self.root)
 
+    def _close(self):
+        self._closed = True
+        self._changes_fp.close()
+        self._storage.close()
+        if self._wal is not None:
+            self._wal.close()
+        if self._file_lock is not None:
+            self._file_lock.close()
+        if self._prefetch_pool is not None:
+            self._prefetch_pool.shutdown()
+
     def clear(self):
         self.logger.debug('Clear JsonDB at %s', self.root)
-        with self._lock:
-            shutil.rmtree(self._object_folder)
-            self._view_data = {view: blist.sortedlist()
-                               for view in self._view_data.keys()}
-            self._id_view_cache = dict()
+        with self._writing():
+            self._storage.clear()
+            if self._wal is not None:
+                self._wal.truncate()
+            shutil.rmtree(self._view_folder, ignore_errors=True)
+            self._forget_documents()
+            # other processes empty their views when they read this
+            self._update_seq += 1
+            change = {'seq': self._update_seq, 'id': None, 'clear': True}
+            self._changes_fp.write(json.dumps(change).encode('utf8') + b'\n')
+            self._changes_fp.flush()
+            self._changes_offset = self._changes_fp.tell()
+            self._notify_changed()
+
+    def _forget_documents(self, views=all):
+        if self._cache is not None:
+            self._cache.clear()
+        for name in list(self._view_data.keys()):
+            if views is all or name in views:
+                self._view_data[name] = blist.sortedlist(key=entry_key)
+                self._id_view_cache.pop(name, None)
+                self._view_reduction.pop(name, None)
+        # a build that is scanning now would bring the old documents back
+        for name in list(self._view_builds.keys()):
+            if views is all or name in views:
+                self._view_builds[name] = _Build()
+
+    def _set_codec(self, codec):
+        # The codec is recorded in the database folder, so that it does
+        # not have to be given every time. Documents written with another
+        # codec can still be read.
+        try:
+            with open(self._codec_file) as f:
+                recorded = f.read().strip()
+        except FileNotFoundError:
+            recorded = None
+        codec = codec or recorded or DEFAULT_CODEC
+        self._storage.encode = encoder(codec)
+        if codec != recorded:
+            os.makedirs(self.root, exist_ok=True)
+            tmp_path = '%s.%i.tmp' % (self._codec_file, os.getpid())
+            with open(tmp_path, 'w') as f:
+                f.write(codec + '\n')
+            os.replace(tmp_path, self._codec_file)
+        self._codec = codec
+
+    def migrate(self, codec=None):
+        with self._writing():
+            if codec is not None:
+                self._set_codec(codec)
+            self.logger.info("Rewriting the documents as %s", self._codec)
+            count = 0
+            for o in self._storage.scan():
+                self._storage.write(_id_from_json(o['_id']), o)
+                count += 1
+            self._storage.sync()
+            self.logger.info("Rewrote %i object%s.", count, 's' if count != 1 else '')
 
     def _setup(self):
-        os.makedirs(self._object_folder, exist_ok=True)
+        with self._writing(catch_up=False):
+            self._update_seq = _read_last_seq(self._changes_file)
+            self._changes_fp = open(self._changes_file, 'ab')
+            if self._changes_fp.tell() > 0:
+                # terminate a torn last line so that new changes start on a fresh one
+                with open(self._changes_file, 'rb') as f:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        self._changes_fp.write(b'\n')
+                        self._changes_fp.flush()
+            self._changes_offset = self._changes_fp.tell()
+
+            self._wal = None
+            if os.path.exists(self._wal_file):
+                self._recover()
+            elif self._durability is not None:
+                self._wal = WriteAheadLog(self._wal_file, self._durability)
+
+    def _recover(self):
+        wal = WriteAheadLog(self._wal_file, self._durability or 'os-buffered')
+        # Only the last record of each document counts, and only where
+        # storage does not already hold it, so that writes that made it
+        # to disk are not logged as changes again
+        records = dict()
+        for record in wal.records():
+            id = _id_from_json(record['id'])
+            records.pop(id, None)
+            records[id] = record
+        count = 0
+        for id, record in records.items():
+            deleted = record.get('deleted', False)
+            try:
+                current = self._storage.read(id)
+            except KeyError:
+                current = None
+            if deleted:
+                if current is None:
+                    continue
+                self._storage.remove(id)
+            else:
+                if current == record['doc']:
+                    continue
+                self._storage.write(id, record['doc'])
+            self._log_change(id, deleted=deleted)
+            count += 1
+        if count:
+            self.logger.info("Replayed %i write%s from the write-ahead log.", count, 's' if count != 1 else '')
+            self._storage.sync()
+        wal.truncate()
+        if self._durability is None:
+            wal.close()
+            os.remove(self._wal_file)
+        else:
+            self._wal = wal
+
+    def _log_ahead(self, records):
+        if self._wal is None:
+            return None
+        return self._wal.append(records)
+
+    def _commit(self, lsn):
+        if lsn is None:
+            return
+        self._wal.commit(lsn)
+        if self._wal.full():
+            with self._writing(catch_up=False):
+                if self._wal.full():
+                    self._storage.sync()
+                    self._wal.truncate()
+
+    @contextlib.contextmanager
+    def _writing(self, catch_up=True):
+        with self.metrics.timer('lock_wait_seconds', mode='write'):
+            self._lock.acquire()
+        try:
+            if self._file_lock is None:
+                yield
+                return
+            with self.metrics.timer('file_lock_wait_seconds', mode='write'):
+                self._file_lock.acquire()
+            try:
+                if catch_up:
+                    self._catch_up()
+                yield
+            finally:
+                self._file_lock.release()
+        finally:
+            self._lock.release()
+
+    @contextlib.contextmanager
+    def _reading(self):
+        if self._file_lock is not None and self._behind():
+            with self._writing():
+                pass
+        with self.metrics.timer('lock_wait_seconds', mode='read'):
+            self._lock.acquire_read()
+        try:
+            if self._file_lock is None:
+                yield
+                return
+            with self._file_lock.shared():
+                yield
+        finally:
+            self._lock.release_read()
+
+    def _behind(self):
+        try:
+            return os.path.getsize(self._changes_file) > self._changes_offset
+        except FileNotFoundError:
+            return False
+
+    def sync(self):
+        with self._writing():
+            pass
+
+    def _catch_up(self):
+        changes = list(self._read_changes(self._update_seq, self._changes_offset))
+        if not changes:
+            return
+        self._apply_changes(changes)
+        self._update_seq = max(self._update_seq, changes[-1][0]['seq'])
+        self._changes_offset = changes[-1][1]
+        self._notify_changed()
+
+    def _apply_changes(self, changes, views=all):
+        changed = dict()
+        for change, _ in changes:
+            if change.get('clear'):
+                # everything before it is gone
+                self._forget_documents(views)
+                changed = dict()
+                continue
+            changed[change['id']] = change.get('deleted', False)
+        for id, deleted in changed.items():
+            if self._cache is not None:
+                self._cache.discard(id)
+            if deleted:
+                self._review({'_id': id}, delete=True, views=views)
+                continue
+            try:
+                o = self._get(id)
+            except KeyError:
+                self._review({'_id': id}, delete=True, views=views)
+            else:
+                self._review(o, delete=True, add=True, views=views)
+        return len(changed)
+
+    def _log_change(self, id, deleted=False):
+        self._log_changes([id], deleted=deleted)
+
+    def _log_changes(self, ids, deleted=False):
+        lines = []
+        for id in ids:
+            self._update_seq += 1
+            change = {'seq': self._update_seq, 'id': id}
+            if deleted:
+                change['deleted'] = True
+            lines.append(json.dumps(change).encode('utf8') + b'\n')
+        self._changes_fp.write(b''.join(lines))
+        self._changes_fp.flush()
+        self._changes_offset = self._changes_fp.tell()
+        self._notify_changed()
+
+    def _notify_changed(self):
+        with self._changed:
+            self._changed.notify_all()
+
+    @property
+    def update_seq(self):
+        with self._reading():
+            return self._update_seq
+
+    def changes(self, since=0, limit=None, include_docs=False, feed='normal', timeout=None):
+        if feed not in ('normal', 'longpoll'):
+            raise ValueError("feed must be 'normal' or 'longpoll'")
+        if feed == 'longpoll':
+            self.wait_for_change(since, timeout=timeout)
+        with self._reading():
+            end = self._changes_offset
+        offset = _seek_changes(self._changes_file, since, end)
+        changes = (change for change, _ in self._read_changes(since, offset, end))
+        changes = itertools.islice(changes, limit)
+        if not include_docs:
+            yield from changes
+            return
+        for change in self._include_docs(changes):
+            if change.get('deleted') or change.get('clear'):
+                # it may have been saved again since
+                change['doc'] = None
+            yield change
+
+    def wait_for_change(self, since, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self._file_lock is not None and self._behind():
+                self.sync()
+            with self._changed:
+                if self._update_seq > since:
+                    return self._update_seq
+                wait = None if deadline is None else deadline - time.monotonic()
+                if wait is not None and wait <= 0:
+                    return self._update_seq
+                if self._file_lock is not None:
+                    # other processes can not wake us up, so look now and then
+                    wait = _POLL_INTERVAL if wait is None else min(wait, _POLL_INTERVAL)
+                self._changed.wait(wait)
 
     def _next_id(self):
         return self._id_generator()
@@ -62,220 +416,819 @@ class Database:
             f.write(str(current + 1))
         return current
 
-    def _get_object_filename(self, id):
-        return self._filename_hasher(id)
-
-    def _default_filename_hasher(self, id):
-        hash_name = hashlib.sha224(str(id).encode('utf8')).hexdigest()
-        return os.path.join(hash_name[:2], hash_name[2:] + '.json')
-
     def __setitem__(self, id, o):
         o['_id'] = id
         self.save(o)
 
     def has(self, id):
-        with self._lock:
-            path = os.path.join(
-                self._object_folder,
-                self._get_object_filename(id)
-            )
-            return os.path.exists(path)
+        with self._reading():
+            return self._exists(id)
 
     def get(self, id):
-        with self._lock:
+        with self._reading():
             return self._get(id)
 
     def _get(self, id):
-        path = os.path.join(
-            self._object_folder,
-            self._get_object_filename(id)
-        )
+        if self._cache is None:
+            # a fresh object, that no one else holds
+            return self._storage.read(id)
+        return copy(self._get_current(id))
+
+    def _get_current(self, id):
+        # The returned document may be shared with the cache, do not modify it
+        if self._cache is None:
+            return self._storage.read(id)
+        key = _id_from_json(id)
         try:
-            with open(path, 'rb') as f:
-                s = f.read().decode('utf8')
-                o = json.loads(s)
-                return o
-        except FileNotFoundError:
-            raise KeyError('Key does not exist: ' + str(id))
+            return self._cache.get(key)
+        except KeyError:
+            o = self._storage.read(id)
+            self._cache.put(key, o)
+            return o
+
+    def _exists(self, id):
+        if self._cache is not None and _id_from_json(id) in self._cache:
+            return True
+        return self._storage.exists(id)
+
+    def cache_info(self):
+        if self._cache is None:
+            return None
+        return self._cache.info()
+
+    def _write(self, id, o):
+        self._storage.write(id, o)
+        if self._cache is not None:
+            self._cache.put(_id_from_json(id), copy(o))
+
+    def _remove(self, id):
+        self._storage.remove(id)
+        if self._cache is not None:
+            self._cache.discard(_id_from_json(id))
 
     def __getitem__(self, key):
         return self.get(key)
 
     def delete(self, id):
-        with self._lock:
-            path = os.path.join(
-                self._object_folder,
-                self._get_object_filename(id)
-            )
-            os.remove(path)
+        with self._writing():
+            if not self._exists(id):
+                raise KeyError('Key does not exist: ' + str(id))
+            lsn = self._log_ahead([{'id': id, 'deleted': True}])
+            self._remove(id)
+            self._log_change(id, deleted=True)
             self._review({'_id': id}, delete=True)
+        self._commit(lsn)
+
+    def delete_many(self, ids):
+        with self._writing():
+            results = []
+            deleted = []
+            seen = set()
+            for id in ids:
+                # an id given twice is gone by the second time
+                if _id_from_json(id) in seen or not self._exists(id):
+                    results.append({'id': id, 'error': 'not_found'})
+                    continue
+                seen.add(_id_from_json(id))
+                deleted.append(id)
+                results.append({'id': id, 'ok': True})
+            lsn = self._log_ahead([{'id': id, 'deleted': True} for id in deleted])
+            for id in deleted:
+                self._remove(id)
+            self._log_changes(deleted, deleted=True)
+            self._review_many([{'_id': id} for id in deleted], delete=True)
+        self._commit(lsn)
+        return results
 
     def save(self, o):
-        with self._lock:
-            id = o.get('_id')
-            if id is None:
-                id = self._next_id()
-                o['_id'] = id
+        with self._writing():
+            id, old = self._check_revision(o)
+            lsn = self._log_ahead([{'id': id, 'doc': o}])
+            self._write(id, o)
+
+            self._log_change(id)
+            self._review(o, delete=True, add=True, old=old)
+        self._commit(lsn)
+        return o
+
+    def save_many(self, docs):
+        with self._writing():
+            results = []
+            saved = []
+            # the last accepted version of each document, which later
+            # documents in the batch check their revision against
+            accepted = dict()
+            olds = dict()
+            for o in docs:
+                try:
+                    id, old = self._check_revision(o, accepted)
+                except Conflict:
+                    results.append({'id': o.get('_id'), 'error': 'conflict'})
+                    continue
+                key = _id_from_json(id)
+                if old is not None and key not in accepted:
+                    # the views hold the version from before the batch
+                    olds[key] = old
+                accepted[key] = o
+                saved.append(o)
+                results.append({'id': id, 'rev': o['_rev'], 'ok': True})
+            lsn = self._log_ahead([{'id': o['_id'], 'doc': o} for o in accepted.values()])
+            for o in accepted.values():
+                self._write(o['_id'], o)
+            self._log_changes([o['_id'] for o in saved])
+            self._review_many(saved, delete=True, add=True, olds=olds)
+        self._commit(lsn)
+        return results
+
+    def _check_revision(self, o, batch=None):
+        # batch holds documents accepted but not yet written, by id
+        id = o.get('_id')
+        if id is None:
+            id = self._next_id()
+            o['_id'] = id
+            o['_rev'] = 0
+
+        try:
+            if batch is not None and _id_from_json(id) in batch:
+                o_current = batch[_id_from_json(id)]
+            else:
+                o_current = self._get_current(id)
+        except KeyError:
+            o_current = None
+
+        if o_current is not None:
+            current_rev = int(o_current['_rev'])
+            if '_rev' not in o:
+                raise Conflict
+            if o['_rev'] is None:
+                raise Conflict
+            challenge_rev = int(o['_rev'])
+            if current_rev != challenge_rev:
+                raise Conflict
+            o['_rev'] = current_rev + 1
+        else:
+            if '_rev' not in o:
                 o['_rev'] = 0
+            elif o['_rev'] is None:
+                o['_rev'] = 0
+        return id, o_current
+
+    def define(self, view_name, map_fn, reduce_fn=None, version=None, build=None):
+        self.define_many([(view_name, map_fn, reduce_fn, version)], build=build)
 
-            path = os.path.join(
-                self._object_folder,
-                self._get_object_filename(id)
-            )
+    def define_many(self, views, build=None):
+        # Takes (view_name, map_fn[, reduce_fn[, version]]) tuples. The
+        # views that need to be built are built in a single scan.
+        build = build or self._view_build
+        if build not in VIEW_BUILDS:
+            raise ValueError('build must be one of ' + ', '.join(VIEW_BUILDS))
+        defined = []
+        unloaded = []
+        with self._writing():
+            for view_name, map_fn, *rest in views:
+                reduce_fn, version = (list(rest) + [None, None])[:2]
+                fingerprint = version if version is not None else _fingerprint(
+                    map_fn, functools.partial(self._warn_unstable, view_name))
+                unchanged = view_name in self._view_map_function and \
+                    self._view_fingerprint.get(view_name) == fingerprint
+                self._view_map_function[view_name] = map_fn
+                self._view_reduce_function[view_name] = reduce_fn
+                self._view_fingerprint[view_name] = fingerprint
+                if unchanged:
+                    # the index is the same, but the reduce function may not be
+                    self._view_reduction[view_name] = _Reduction()
+                    continue
+                defined.append(view_name)
+                if build == 'eager':
+                    self._view_builds.pop(view_name, None)
+                    if not self._load_view(view_name, fingerprint):
+                        unloaded.append(view_name)
+                else:
+                    self._view_builds[view_name] = _Build()
+                    self._view_data.pop(view_name, None)
+                    self._id_view_cache.pop(view_name, None)
+                    self._view_reduction.pop(view_name, None)
+        if build == 'background':
+            for view_name in defined:
+                threading.Thread(target=self._ensure_view, args=(view_name,),
+                                 name='jsondb-build', daemon=True).start()
+        elif unloaded:
+            self.reindex(views=unloaded)
+            self.checkpoint(views=unloaded)
+        self._checkpoint_caught_up()
+
+    def create_index(self, *fields, name=None, build=None):
+        # A view keyed on the values of the fields, given as dotted paths,
+        # which needs no map function. It is recorded in the database
+        # folder and defined again whenever the database is opened.
+        index = FieldIndex(fields)
+        name = name or 'by_' + '_'.join(field.replace('.', '_') for field in index.fields)
+        self.define(name, index, build=build)
+        with self._writing():
+            # another process may have changed the indexes since they were read
+            self._indexes = self._read_indexes()
+            self._indexes[name] = list(index.fields)
+            self._write_indexes()
+        return name
+
+    def drop_index(self, name):
+        with self._writing():
+            self._indexes = self._read_indexes()
+            if name not in self._indexes:
+                raise KeyError('Index does not exist: ' + str(name))
+            del self._indexes[name]
+            self._write_indexes()
+            for views in (self._view_map_function, self._view_reduce_function,
+                          self._view_fingerprint, self._view_data, self._id_view_cache,
+                          self._view_reduction, self._view_builds, self._view_checkpoint_seq):
+                views.pop(name, None)
+            for path in (self._get_view_filename(name), self._get_frozen_filename(name)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def _read_indexes(self):
+        try:
+            with open(self._indexes_file) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return dict()
+
+    def _write_indexes(self):
+        tmp_path = '%s.%i.tmp' % (self._indexes_file, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(self._indexes, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self._indexes_file)
+
+    def _warn_unstable(self, view_name, value):
+        self.logger.warning("The map function of view %s uses %r, so a change to it would not "
+                            "be noticed. Pass version= to define() to say when the view changes.",
+                            view_name, value)
 
+    def _ensure_view(self, name):
+        # Build a view that was defined as lazy or background, or wait for
+        # the build that is already going on
+        while True:
+            with self._build_mutex:
+                build = self._view_builds.get(name)
+                if build is None:
+                    return
+                claimed = not build.claimed
+                build.claimed = True
+            if claimed:
+                self._build_view(name, build)
+            build.ready.wait()
+            if build.error is not None:
+                raise build.error
+
+    def _build_view(self, name, build):
+        try:
+            with self._writing():
+                if self._view_builds.get(name) is not build:
+                    return
+                map_fn = self._view_map_function[name]
+                # the changes since the checkpoint go to the loaded view
+                del self._view_builds[name]
+                loaded = self._load_view(name, self._view_fingerprint[name])
+                if not loaded:
+                    self._view_builds[name] = build
+                    # Writes from now on are queued, as the scan below may
+                    # or may not see them
+                    build.queue = set()
+            if loaded:
+                self._checkpoint_caught_up()
+                return
+
+            self.logger.info("Building view %s", name)
+            entries = []
+            for o in self._storage.scan():
+                with self.metrics.timer('map_seconds', view=name):
+                    entries.extend(_map(map_fn, o))
+            entries.sort(key=entry_key)
+
+            with self._writing():
+                if self._view_builds.get(name) is not build:
+                    return
+                id_view_cache = dict()
+                for v in entries:
+                    id_view_cache.setdefault(_id_from_json(v.id), list()).append(v)
+                self._view_data[name] = blist.sortedlist(entries, key=entry_key)
+                self._id_view_cache[name] = id_view_cache
+                self._view_reduction[name] = _Reduction()
+                del self._view_builds[name]
+                self._apply_changes([({'id': id}, None) for id in build.queue], views=[name])
+            self.checkpoint(views=[name])
+        except Exception as e:
+            build.error = e
+            raise
+        finally:
+            build.ready.set()
+
+    def all_docs(self, key=any, startkey=None, endkey=any, include_docs=False,
+                 skip=0, limit=None):
+        # The id index is an ordinary view, built (or loaded from its
+        # checkpoint) the first time it is asked for, and kept up to date
+        # from then on
+        with self._all_docs_mutex:
+            if ALL_DOCS not in self._view_map_function:
+                self.define(ALL_DOCS, _all_docs_map)
+        return self.view(ALL_DOCS, key=key, startkey=startkey, endkey=endkey,
+                         include_docs=include_docs, skip=skip, limit=limit)
+
+    def checkpoint(self, views=all):
+        with self._writing():
+            os.makedirs(self._view_folder, exist_ok=True)
+            offset = self._changes_offset
+            for name in sorted(self._view_data.keys()):
+                if views is not all and name not in views:
+                    continue
+                if isinstance(self._view_data[name], _FrozenView):
+                    # kept by its frozen file and the changes since
+                    continue
+                state = {
+                    'format': VIEW_FORMAT,
+                    'fingerprint': self._view_fingerprint.get(name),
+                    'seq': self._update_seq,
+                    'offset': offset,
+                    'rows': [(v.id, v.key, v.value)
+                             for v in self._view_data[name]],
+                }
+                path = self._get_view_filename(name)
+                try:
+                    with open(path + '.tmp', 'wb') as f:
+                        pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+                except (pickle.PicklingError, TypeError, AttributeError) as e:
+                    self.logger.warning("Could not persist view %s: %s", name, e)
+                    os.remove(path + '.tmp')
+                    continue
+                os.replace(path + '.tmp', path)
+                self._view_checkpoint_seq[name] = self._update_seq
+
+    def _get_view_filename(self, view_name):
+        hash_name = hashlib.sha224(str(view_name).encode('utf8')).hexdigest()
+        return os.path.join(self._view_folder, hash_name + '.view')
+
+    def freeze(self, view_name):
+        # Write the view to a file which is memory-mapped from then on, in
+        # this process and in any that loads the view later
+        self._ensure_view(view_name)
+        with self._writing():
+            os.makedirs(self._view_folder, exist_ok=True)
+            view_data = self._view_data[view_name]
+            header = {
+                'format': VIEW_FORMAT,
+                'fingerprint': self._view_fingerprint.get(view_name),
+                'seq': self._update_seq,
+                'offset': self._changes_offset,
+            }
+            path = self._get_frozen_filename(view_name)
+            write_frozen(path, header, (
+                (v.sort_key, _collate(_id_from_json(v.id)),
+                 pickle.dumps((v.id, v.key, v.value), pickle.HIGHEST_PROTOCOL))
+                for v in _rows(view_data, 0, len(view_data))))
+            self._view_data[view_name] = _FrozenView(FrozenIndex(path))
+            self._id_view_cache[view_name] = dict()
+            # the frozen view is newer than any checkpoint
             try:
-                with open(path, 'rb') as f:
-                    s = f.read().decode('utf8')
-                    o_current = json.loads(s)
-            except IOError:
-                o_current = None
-
-            if o_current is not None:
-                current_rev = int(o_current['_rev'])
-                if '_rev' not in o:
-                    raise Conflict
-                if o['_rev'] is None:
-                    raise Conflict
-                challenge_rev = int(o['_rev'])
-                if current_rev != challenge_rev:
-                    raise Conflict
-                o['_rev'] = current_rev + 1
-            else:
-                if '_rev' not in o:
-                    o['_rev'] = 0
-                elif o['_rev'] is None:
-                    o['_rev'] = 0
+                os.remove(self._get_view_filename(view_name))
+            except FileNotFoundError:
+                pass
 
-            os.makedirs(os.path.dirname(path), exist_ok=True)
-            s = json.dumps(o, indent=2)
-            with open(path, 'wb') as f:
-                f.write(s.encode('utf8'))
+    def _get_frozen_filename(self, view_name):
+        return self._get_view_filename(view_name)[:-len('.view')] + '.frozen'
 
-            self._review(o, delete=True, add=True)
-            return o
+    def _load_view(self, view_name, fingerprint):
+        state = self._load_frozen(view_name, fingerprint) or \
+            self._load_checkpoint(view_name, fingerprint)
+        if state is None:
+            return False
+        changes = self._read_changes(state['seq'], state['offset'], self._changes_offset)
+        count = self._apply_changes(changes, views=[view_name])
+        self.logger.info("Caught up %i changed object%s.", count, 's' if count != 1 else '')
+        if count > _CATCH_UP_LIMIT:
+            self._caught_up.add(view_name)
+        return True
 
-    def define(self, view_name, map_fn, reduce_fn=None):
-        with self._lock:
-            self._view_map_function[view_name] = map_fn
-            self._view_reduce_function[view_name] = reduce_fn
-            self._view_data[view_name] = \
-                blist.sortedlist(key=view_key)
-        self.reindex(views=[view_name])
+    def _checkpoint_caught_up(self):
+        # A view that had to catch up with many changes when it was loaded
+        # is saved again, so that the next start does not redo the work
+        with self._writing():
+            names, self._caught_up = self._caught_up, set()
+        if names:
+            self.checkpoint(views=names)
 
-    def reindex(self, views=all):
-        with self._lock:
+    def _load_frozen(self, view_name, fingerprint):
+        path = self._get_frozen_filename(view_name)
+        try:
+            index = FrozenIndex(path)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            self.logger.warning("Could not load frozen view %s: %s", view_name, e)
+            return None
+        state = index.header
+        if state.get('format') != VIEW_FORMAT or state.get('fingerprint') != fingerprint:
+            self.logger.info("View %s has changed, discarding frozen index", view_name)
+            index.close()
+            os.remove(path)
+            return None
+
+        self.logger.info("Loading frozen view %s at seq %i", view_name, state['seq'])
+        self._view_data[view_name] = _FrozenView(index)
+        self._id_view_cache[view_name] = dict()
+        self._view_reduction[view_name] = _Reduction()
+        return state
+
+    def _load_checkpoint(self, view_name, fingerprint):
+        path = self._get_view_filename(view_name)
+        try:
+            with open(path, 'rb') as f:
+                state = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            self.logger.warning("Could not load view %s: %s", view_name, e)
+            return None
+        if state.get('format') != VIEW_FORMAT or state.get('fingerprint') != fingerprint:
+            self.logger.info("View %s has changed, discarding stored index", view_name)
+            return None
+
+        self.logger.info("Loading view %s from checkpoint at seq %i", view_name, state['seq'])
+        id_view_cache = dict()
+        entries = []
+        for id, k, v in state['rows']:
+            entry = _entry(id, k, v)
+            entries.append(entry)
+            id_view_cache.setdefault(_id_from_json(id), list()).append(entry)
+        self._view_data[view_name] = blist.sortedlist(entries, key=entry_key)
+        self._id_view_cache[view_name] = id_view_cache
+        self._view_reduction[view_name] = _Reduction()
+        self._view_checkpoint_seq[view_name] = state['seq']
+        return state
+
+    def _read_changes(self, since=0, offset=0, end=None):
+        with open(self._changes_file, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            if offset > f.tell():
+                offset = 0
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                offset += len(line)
+                if end is not None and offset > end:
+                    break
+                try:
+                    change = json.loads(line.decode('utf8'))
+                except ValueError:
+                    continue
+                if change['seq'] <= since:
+                    continue
+                change['id'] = _id_from_json(change['id'])
+                yield change, offset
+
+    def reindex(self, views=all, processes=None, progress=None):
+        if processes is None:
+            processes = self._reindex_processes
+        with self._writing():
             self.logger.info("Generating views (%s)", "all" if views is all else ', '.join(views))
-            count = 0
-            for name in sorted(self._view_map_function.keys()):
-                if views is all or name in views:
-                    self._view_data[name] = \
-                        blist.sortedlist(key=view_key)
-            for r, ds, fs in os.walk(self._object_folder):
-                for f in fs:
-                    if f.endswith('.json'):
-                        path = os.path.join(r, f)
-                        with open(path, 'rb') as f:
-                            s = f.read().decode('utf8')
-                            o = json.loads(s)
-                            self._review(o, add=True, views=views)
-                            count += 1
+            names = [name for name in sorted(self._view_map_function.keys())
+                     if views is all or name in views]
+            for name in names:
+                build = self._view_builds.pop(name, None)
+                if build is not None:
+                    build.ready.set()
+                self._view_data[name] = \
+                    blist.sortedlist(key=entry_key)
+                self._id_view_cache[name] = dict()
+                self._view_reduction[name] = _Reduction()
+            if processes is not None and processes > 1 and \
+                    self._can_reindex_in_parallel(names):
+                count = self._reindex_parallel(names, processes, progress)
+            else:
+                count = 0
+                for o in self._storage.scan():
+                    self._review(o, add=True, views=names)
+                    count += 1
+                    if progress is not None and count % 1000 == 0:
+                        progress(count)
+                if progress is not None and count % 1000 != 0:
+                    progress(count)
             self.logger.info("Indexed %i object%s.", count, 's' if count != 1 else '')
 
+    def _can_reindex_in_parallel(self, names):
+        if not hasattr(self._storage, 'partitions'):
+            self.logger.info("The storage can not be partitioned, indexing in one process.")
+            return False
+        for name in names:
+            try:
+                pickle.dumps(self._view_map_function[name])
+            except (pickle.PicklingError, TypeError, AttributeError):
+                self.logger.warning("The map function of view %s can not be sent to "
+                                    "another process, indexing in one process.", name)
+                return False
+        return True
+
+    def _reindex_parallel(self, names, processes, progress):
+        maps = {name: self._view_map_function[name] for name in names}
+        tasks = [(self._storage.scan_partition, partition, maps)
+                 for partition in self._storage.partitions()]
+        partials = {name: [] for name in names}
+        count = 0
+        with multiprocessing.Pool(processes) as pool:
+            for partition_count, rows in pool.imap_unordered(_map_partition, tasks):
+                count += partition_count
+                for name in names:
+                    partials[name].append(rows[name])
+                if progress is not None:
+                    progress(count)
+        for name in names:
+            # blist adds the rows one at a time, in any order
+            entries = list(itertools.chain.from_iterable(partials[name]))
+            id_view_cache = self._id_view_cache[name]
+            for v in entries:
+                id_view_cache.setdefault(_id_from_json(v.id), []).append(v)
+            self._view_data[name] = blist.sortedlist(entries, key=entry_key)
+        return count
+
     def view(self, view_name, key=any, startkey=None, endkey=any,
              include_docs=False, group=False, no_reduce=False,
-             skip=0, limit=None):
+             skip=0, limit=None, startkey_docid=None, endkey_docid=None,
+             group_level=None, keys=None):
 
-        with self._lock:
+        if keys is not None and (key is not any or startkey is not None or endkey is not any):
+            raise ValueError('keys can not be combined with key, startkey or endkey')
+        self._ensure_view(view_name)
+        with self._reading():
             view_data = self._view_data[view_name]
 
-            if key is not any:
-                key = {'key': key}
-                startindex = view_data.bisect_left(key)
-                key_ref = view_key(key)
-                endindex = len(view_data)
+            if keys is not None:
+                ranges = _key_ranges(view_data, keys)
 
             else:
-                if startkey is None:
-                    startindex = 0
-                elif startkey is any:
-                    startindex = len(view_data)
-                else:
-                    startkey = {'key': startkey}
-                    l = view_data.bisect_left(startkey)
-                    r = view_data.bisect_right(startkey)
-                    if l == r:
-                        startindex = l
-                    else:
-                        startindex = l
-
-                if endkey is None:
-                    endindex = 0
-                elif endkey is any:
-                    endindex = len(view_data)
-                else:
-                    endkey = {'key': endkey}
-                    l = view_data.bisect_left(endkey)
-                    r = view_data.bisect_right(endkey)
-                    if l == r:
-                        endindex = l
-                    else:
-                        endindex = r
+                startindex, endindex = _index_range(view_data, _bounds(
+                    key, startkey, endkey, startkey_docid, endkey_docid))
 
+            # Iterate over a snapshot so that no lock is held while the
+            # caller consumes the rows. Copying a blist is copy-on-write.
+            view_data = _snapshot(view_data)
             reduce_fn = self._view_reduce_function[view_name]
+            if reduce_fn is not None and not no_reduce:
+                reduction = self._view_reduction.get(view_name)
+                if reduction is None:
+                    reduction = self._view_reduction.setdefault(view_name, _Reduction())
+                reduce_fn = self.metrics.timed(reduce_fn, 'reduce_seconds', view=view_name)
+                reducer = _Reducer(view_data, reduce_fn, reduction, self._version)
+
+        if keys is not None:
+            self.metrics.count('view_rows_scanned', sum(e - s for s, e in ranges), view=view_name)
+            stop = None if limit is None else skip + limit
             if reduce_fn is None or no_reduce:
-                counter = 0
-                for v in view_data[startindex:endindex]:
-                    counter += 1
-                    if key is not any:
-                        if key_ref != view_key(v):
-                            break
-                    if counter <= skip:
-                        continue
-                    if include_docs:
-                        v = dict(v)
-                        v['doc'] = self._get(v['id'])
-                    yield v
+                rows = itertools.chain.from_iterable(_rows(view_data, s, e) for s, e in ranges)
+                rows = (v.to_dict() for v in itertools.islice(rows, skip, stop))
+                if include_docs:
+                    rows = self._include_docs(rows)
             else:
-                if group:
-                    last_key = None
-                    values = []
-                    for v in view_data[startindex:endindex]:
-                        if key is not any:
-                            if key_ref != view_key(v):
-                                break
-                        this_key = v['key']
-                        if last_key is not None and this_key != last_key:
-                            yield {'key': last_key, 'value': reduce_fn([last_key], values, False)}
-                            values = []
-                        last_key = this_key
-                        values.append(v['value'])
-                    if len(values) > 0:
-                        yield {'key': this_key, 'value': reduce_fn([this_key], values, False)}
-                else:
-                    raise NotImplementedError('Reduce without grouping not implemented')
+                rows = self._reduced_keys(reducer, ranges, group or group_level, skip, stop)
+            yield from self._counted(rows, view_name)
+        elif reduce_fn is None or no_reduce:
+            startindex += skip
+            if limit is not None:
+                endindex = min(endindex, startindex + limit)
+            self.metrics.count('view_rows_scanned', max(0, endindex - startindex), view=view_name)
+            rows = (v.to_dict() for v in _rows(view_data, startindex, endindex))
+            if include_docs:
+                rows = self._include_docs(rows)
+            yield from self._counted(rows, view_name)
+        else:
+            self.metrics.count('view_rows_scanned', max(0, endindex - startindex), view=view_name)
+            yield from self._counted(self._reduced(
+                reducer, startindex, endindex, group, group_level, skip, limit), view_name)
 
-    def _review(self, o, delete=False, add=False, views=all):
-        id = o['_id']
+    def _counted(self, rows, view_name):
+        returned = 0
+        try:
+            for v in rows:
+                returned += 1
+                yield v
+        finally:
+            self.metrics.count('view_rows_returned', returned, view=view_name)
 
-        def create_view_data(o, row):
-            k, v = row
-            return {
-                'id': o['_id'],
-                'key': k,
-                'value': v,
-            }
+    def _reduced(self, reducer, startindex, endindex, group, group_level, skip, limit):
+        try:
+            if group:
+                groups = reducer.groups(startindex, endindex)
+            elif group_level:
+                # a block can stand in for its keys if they all fall in
+                # the same group
+                groups = reducer.pieces(
+                    startindex, endindex,
+                    lambda first, last: _group_of(first, group_level) == _group_of(last, group_level))
+                groups = _regroup(((first, value) for first, _, value, _ in groups),
+                                  group_level, reducer.reduce_fn)
+            if group or group_level:
+                stop = None if limit is None else skip + limit
+                for this_key, value in itertools.islice(groups, skip, stop):
+                    yield {'key': this_key, 'value': value}
+            elif skip == 0 and limit != 0:
+                value = reducer.reduce(startindex, endindex)
+                if value is not _MISSING:
+                    yield {'key': None, 'value': value}
+        finally:
+            self._cache_reductions(reducer)
+
+    def query(self, *conditions, union=False, include_docs=False, limit=None):
+        # Each condition is a dict with a view name under 'view' and the
+        # key, startkey, endkey, startkey_docid, endkey_docid or keys to
+        # look for in it. Gives the ids of the documents that match all
+        # of them, or any of them with union=True.
+        if not conditions:
+            raise ValueError('query needs at least one condition')
+        parsed = []
+        for condition in conditions:
+            condition = dict(condition)
+            name = condition.pop('view')
+            keys = condition.pop('keys', None)
+            if keys is not None:
+                bounds = [_bounds(key=key) for key in keys]
+            else:
+                bounds = [_bounds(**condition)]
+            parsed.append((name, [b for b in bounds if b is not None]))
+            self._ensure_view(name)
+
+        with self._reading():
+            planned = []
+            for name, bounds in parsed:
+                view_data = self._view_data[name]
+                ranges = [_index_range(view_data, b) for b in bounds]
+                planned.append((sum(e - s for s, e in ranges), name, bounds, ranges))
+            if union:
+                ids = self._union(planned, limit)
+            else:
+                ids = self._intersect(planned, limit)
+
+        rows = ({'id': id} for id in ids)
+        if include_docs:
+            rows = self._include_docs(rows)
+        yield from rows
+
+    def _intersect(self, planned, limit):
+        # Walk the condition with the fewest rows, and look up the rows of
+        # each document found there in the other views
+        planned.sort(key=operator.itemgetter(0))
+        _, name, _, ranges = planned[0]
+        view_data = self._view_data[name]
+        ids = []
+        seen = set()
+        for v in itertools.chain.from_iterable(_rows(view_data, s, e) for s, e in ranges):
+            id = _id_from_json(v.id)
+            if id in seen:
+                continue
+            seen.add(id)
+            if all(self._matches(other, id, bounds) for _, other, bounds, _ in planned[1:]):
+                ids.append(v.id)
+                if limit is not None and len(ids) >= limit:
+                    break
+        return ids
+
+    def _union(self, planned, limit):
+        ids = []
+        seen = set()
+        for _, name, _, ranges in planned:
+            view_data = self._view_data[name]
+            for v in itertools.chain.from_iterable(_rows(view_data, s, e) for s, e in ranges):
+                id = _id_from_json(v.id)
+                if id not in seen:
+                    seen.add(id)
+                    ids.append(v.id)
+                    if limit is not None and len(ids) >= limit:
+                        return ids
+        return ids
+
+    def _matches(self, name, id, bounds):
+        rows = self._id_view_cache[name].get(id, ())
+        view_data = self._view_data[name]
+        if isinstance(view_data, _FrozenView):
+            rows = itertools.chain(rows, view_data.frozen_rows(_collate(id)))
+        return any(_within(v.sort_key, b) for v in rows for b in bounds)
+
+    def _reduced_keys(self, reducer, ranges, group, skip, stop):
+        try:
+            groups = (next(reducer.groups(s, e)) for s, e in ranges if s < e)
+            if group:
+                for this_key, value in itertools.islice(groups, skip, stop):
+                    yield {'key': this_key, 'value': value}
+            elif skip == 0 and stop != 0:
+                values = [value for _, value in groups]
+                if values:
+                    yield {'key': None, 'value': reducer.reduce_fn(None, values, True)}
+        finally:
+            self._cache_reductions(reducer)
+
+    def _include_docs(self, rows):
+        if not self._prefetch_threads:
+            for v in rows:
+                v['doc'] = self._read_docs([v['id']])[1][0]
+                yield v
+            return
+
+        # Read the documents of the next window of rows in the background
+        # while the rows of this one are handed out
+        pool = self._get_prefetch_pool()
+        pending = collections.deque()
+        windows = iter(lambda: list(itertools.islice(rows, _PREFETCH_WINDOW)), [])
+        for window in windows:
+            ids = list({_id_from_json(v['id']): v['id'] for v in window}.values())
+            chunk = -(-len(ids) // self._prefetch_threads)
+            futures = [(ids[i:i + chunk], pool.submit(self._read_docs, ids[i:i + chunk]))
+                       for i in range(0, len(ids), chunk)]
+            pending.append((window, futures))
+            if len(pending) > 1:
+                yield from self._attach_docs(*pending.popleft())
+        while pending:
+            yield from self._attach_docs(*pending.popleft())
+
+    def _attach_docs(self, window, futures):
+        docs = dict()
+        for ids, future in futures:
+            seq, read = future.result()
+            docs.update((_id_from_json(id), (seq, doc)) for id, doc in zip(ids, read))
+        seen = set()
+        for v in window:
+            key = _id_from_json(v['id'])
+            seq, doc = docs[key]
+            if seq != self._update_seq:
+                # written since it was read ahead, hand out what is there now
+                seq, (doc,) = self._read_docs([v['id']])
+                docs[key] = seq, doc
+                seen.discard(key)
+            # every row gets a document of its own, like with separate reads
+            v['doc'] = copy(doc) if key in seen else doc
+            seen.add(key)
+            yield v
+
+    def _read_docs(self, ids):
+        docs = []
+        with self._reading():
+            for id in ids:
+                try:
+                    docs.append(self._get(id))
+                except KeyError:
+                    # deleted after the snapshot was taken
+                    docs.append(None)
+            return self._update_seq, docs
+
+    def _get_prefetch_pool(self):
+        with self._prefetch_mutex:
+            if self._prefetch_pool is None:
+                self._prefetch_pool = ThreadPoolExecutor(
+                    max_workers=self._prefetch_threads, thread_name_prefix='jsondb-prefetch')
+            return self._prefetch_pool
+
+    def _cache_reductions(self, reducer):
+        # Keep what a query computed, all at once, and only if it was
+        # computed from a snapshot that is still current
+        if not reducer.found:
+            return
+        with self._lock.read():
+            if self._version == reducer.version:
+                reducer.reduction.store(reducer)
+
+    def _invalidate_reductions(self, name, entries):
+        self._version += 1
+        reduction = self._view_reduction.get(name)
+        if reduction is None or not reduction.filled:
+            return
+        for v in entries:
+            reduction.invalidate(collate(v.key))
+
+    def _get_view(self, name):
+        try:
+            return self._view_data[name], self._id_view_cache[name]
+        except KeyError:
+            view_data = blist.sortedlist(key=entry_key)
+            self._view_data[name] = view_data
+            id_view_cache = dict()
+            self._id_view_cache[name] = id_view_cache
+            return view_data, id_view_cache
+
+    def _review(self, o, delete=False, add=False, views=all, old=None):
+        # old is the version of the document that the views hold, if known
+        id = _id_from_json(o['_id'])
 
         for name, fn in self._view_map_function.items():
             if views is not all and name not in views:
                 continue
-            try:
-                view_data = self._view_data[name]
-                id_view_cache = self._id_view_cache[name]
-            except KeyError:
-                view_data = blist.sortedlist(key=view_key)
-                self._view_data[name] = view_data
-                id_view_cache = dict()
-                self._id_view_cache[name] = id_view_cache
+            if name in self._view_builds:
+                self._view_builds[name].enqueue([id])
+                continue
+            if old is not None and isinstance(fn, FieldIndex) and fn.unchanged(old, o):
+                continue
+            view_data, id_view_cache = self._get_view(name)
+
+            if delete and isinstance(view_data, _FrozenView):
+                self._invalidate_reductions(name, view_data.mask(_collate(id)))
 
             if delete and id in id_view_cache.keys():
                 for v in id_view_cache[id]:
@@ -283,6 +1236,7 @@ class Database:
                         view_data.remove(v)
                     except ValueError:
                         pass
+                self._invalidate_reductions(name, id_view_cache[id])
                 del id_view_cache[id]
 
             if add:
@@ -292,26 +1246,676 @@ class Database:
                     this_id_view_cache = list()
                     id_view_cache[id] = this_id_view_cache
 
-                rows = fn(o)
-                if rows is None:
-                    continue
-                if hasattr(rows, '__next__'):
-                    for row in rows:
-                        v = create_view_data(o, row)
-                        view_data.add(v)
-                        this_id_view_cache.append(v)
-                else:
-                    v = create_view_data(o, rows)
+                with self.metrics.timer('map_seconds', view=name):
+                    rows = list(_map(fn, o))
+                for v in rows:
                     view_data.add(v)
                     this_id_view_cache.append(v)
+                self._invalidate_reductions(name, this_id_view_cache)
+
+    def _review_many(self, docs, delete=False, add=False, views=all, olds=None):
+        # Only the last version of a document saved twice in a batch counts
+        all_docs = {_id_from_json(o['_id']): o for o in docs}
+
+        for name, fn in self._view_map_function.items():
+            if views is not all and name not in views:
+                continue
+            if name in self._view_builds:
+                self._view_builds[name].enqueue(all_docs.keys())
+                continue
+            docs = all_docs
+            if olds and isinstance(fn, FieldIndex):
+                docs = {id: o for id, o in all_docs.items()
+                        if id not in olds or not fn.unchanged(olds[id], o)}
+            view_data, id_view_cache = self._get_view(name)
+
+            if delete and isinstance(view_data, _FrozenView):
+                for id in docs.keys():
+                    self._invalidate_reductions(name, view_data.mask(_collate(id)))
+
+            if delete:
+                for id in docs.keys():
+                    entries = id_view_cache.pop(id, ())
+                    for v in entries:
+                        try:
+                            view_data.remove(v)
+                        except ValueError:
+                            pass
+                    self._invalidate_reductions(name, entries)
+
+            if add:
+                chunk = []
+                for id, o in docs.items():
+                    with self.metrics.timer('map_seconds', view=name):
+                        rows = list(_map(fn, o))
+                    id_view_cache[id] = rows
+                    chunk.extend(rows)
+                self._invalidate_reductions(name, chunk)
+                # blist adds the rows one at a time either way, so there is
+                # nothing to gain from sorting the chunk first
+                view_data.update(chunk)
 
 
 class Conflict(Exception):
     pass
 
 
+_PREFETCH_WINDOW = 64
+# changes a loaded view may have to catch up with before it is saved again
+_CATCH_UP_LIMIT = 1000
+# keys in a block of cached reductions
+_REDUCE_BLOCK = 128
+
+
+def _regroup(groups, group_level, reduce_fn):
+    last_key = None
+    values = []
+    for this_key, value in groups:
+        if isinstance(this_key, tuple):
+            this_key = this_key[:group_level]
+        if values and this_key != last_key:
+            yield last_key, reduce_fn(None, values, True)
+            values = []
+        last_key = this_key
+        values.append(value)
+    if values:
+        yield last_key, reduce_fn(None, values, True)
+
+
+def _group_of(key, group_level):
+    if isinstance(key, tuple):
+        return key[:group_level]
+    return key
+
+
+_MISSING = object()
+# (value, first key, last key, number of keys) of a block without keys
+_EMPTY_BLOCK = (None, None, None, 0)
+
+
+class _Reduction:
+    # The cached reductions of a view. Besides the value of each whole
+    # key, the keys are cut into blocks of consecutive keys that each keep
+    # the rereduced value of their keys, so that a reduce over many keys
+    # mostly combines block values. A write drops the values of the keys
+    # it touches and of the blocks they are in, and nothing else.
+
+    def __init__(self):
+        self.keys = dict()
+        # the group key each block starts at, the first one at the very
+        # start, and (value, first key, last key, number of keys) of each
+        # block, or None where that is not known
+        self.bounds = [b'']
+        self.blocks = [None]
+        self.whole = None
+        self.filled = False
+        # queries store under the shared read lock
+        self.mutex = threading.Lock()
+
+    def invalidate(self, group_key):
+        self.keys.pop(group_key, None)
+        self.blocks[bisect.bisect_right(self.bounds, group_key) - 1] = None
+        self.whole = None
+
+    def store(self, reducer):
+        with self.mutex:
+            self.filled = True
+            self.keys.update(reducer.found_keys)
+            for start, end, parts in reducer.found_blocks:
+                i = bisect.bisect_left(self.bounds, start)
+                if i == len(self.bounds) or self.bounds[i] != start or self.blocks[i] is not None:
+                    # already stored by another query
+                    continue
+                if (self.bounds[i + 1] if i + 1 < len(self.bounds) else None) != end:
+                    continue
+                # a block that has grown is split, one left without keys
+                # goes to the block before it
+                self.bounds[i:i + 1] = [bound for bound, _ in parts]
+                self.blocks[i:i + 1] = [block for _, block in parts]
+            if reducer.found_whole is not None:
+                self.whole = reducer.found_whole
+
+
+class _Reducer:
+    # Reduces the rows of one query, from a snapshot of the view and of
+    # the blocks, and collects the values it computes so that they can be
+    # cached afterwards in one go
+
+    def __init__(self, view_data, reduce_fn, reduction, version):
+        self.view_data = view_data
+        self.reduce_fn = reduce_fn
+        self.reduction = reduction
+        self.version = version
+        self.bounds = list(reduction.bounds)
+        self.blocks = list(reduction.blocks)
+        self.whole = reduction.whole
+        self.found_keys = dict()
+        self.found_blocks = []
+        self.found_whole = None
+
+    @property
+    def found(self):
+        return bool(self.found_keys or self.found_blocks or self.found_whole is not None)
+
+    def reduce(self, startindex, endindex):
+        # The value of all rows in the range, or _MISSING if there are none
+        whole = startindex == 0 and endindex == len(self.view_data)
+        if whole and self.whole is not None:
+            return self.whole[0]
+        pieces = list(self.pieces(startindex, endindex))
+        if not pieces:
+            return _MISSING
+        if len(pieces) == 1 and pieces[0][3]:
+            # a single block, already rereduced
+            value = pieces[0][2]
+        else:
+            value = self.reduce_fn(None, [value for _, _, value, _ in pieces], True)
+        if whole:
+            self.found_whole = (value,)
+        return value
+
+    def groups(self, startindex, endindex):
+        # Reductions are cached per key, and only for whole keys, as a
+        # startkey_docid or endkey_docid can cut a key in two
+        view_data = self.view_data
+        index = startindex
+        while index < endindex:
+            this_key = view_data[index].key
+            group_key = collate(this_key)
+            end = view_data.bisect_right(Row(group_key + _HIGH))
+            whole = end <= endindex and (
+                index > startindex or
+                view_data.bisect_left(Row(group_key + _LOW)) == index)
+            end = min(end, endindex)
+            value = _MISSING
+            if whole:
+                value = self.reduction.keys.get(group_key, self.found_keys.get(group_key, _MISSING))
+            if value is _MISSING:
+                values = [v.value for v in _rows(view_data, index, end)]
+                value = self.reduce_fn([this_key], values, False)
+                if whole:
+                    self.found_keys[group_key] = value
+            yield this_key, value
+            index = end
+
+    def pieces(self, startindex, endindex, usable=None):
+        # (first key, last key, value, rereduced) of consecutive parts of
+        # the range, a whole block where the range covers it and
+        # usable(first key, last key) agrees, a single key elsewhere
+        if startindex >= endindex:
+            return
+        first = self._block_of(self.view_data[startindex].key)
+        last = self._block_of(self.view_data[endindex - 1].key)
+        for i in range(first, last + 1):
+            start = self._block_start(i) if i == first else None
+            end = self._block_start(i + 1) if i == last else None
+            if (start is None or startindex <= start) and (end is None or end <= endindex):
+                block = self.blocks[i]
+                parts = [block] if block is not None else self._reduce_block(i)
+                if usable is None or all(usable(part[1], part[2]) for part in parts if part[3]):
+                    for value, first_key, last_key, count in parts:
+                        if count:
+                            yield first_key, last_key, value, True
+                    continue
+            # the keys one by one, where the range only covers part of the
+            # block or the block can not be used
+            start = max(startindex, self._block_start(i) if start is None else start)
+            end = min(endindex, self._block_start(i + 1) if end is None else end)
+            for this_key, value in self.groups(start, end):
+                yield this_key, this_key, value, False
+
+    def _block_of(self, key):
+        return bisect.bisect_right(self.bounds, collate(key)) - 1
+
+    def _block_start(self, i):
+        if i == 0:
+            return 0
+        if i == len(self.bounds):
+            return len(self.view_data)
+        return self.view_data.bisect_left(Row(self.bounds[i] + _LOW))
+
+    def _reduce_block(self, i):
+        # Reduces a block from its keys, splitting it if it has grown past
+        # twice the block size
+        groups = list(self.groups(self._block_start(i), self._block_start(i + 1)))
+        size = _REDUCE_BLOCK if len(groups) > 2 * _REDUCE_BLOCK else max(1, len(groups))
+        parts = []
+        for n in range(0, len(groups), size):
+            chunk = groups[n:n + size]
+            bound = self.bounds[i] if n == 0 else collate(chunk[0][0])
+            value = self.reduce_fn(None, [value for _, value in chunk], True)
+            parts.append((bound, (value, chunk[0][0], chunk[-1][0], len(chunk))))
+        if not parts and i == 0:
+            parts.append((self.bounds[0], _EMPTY_BLOCK))
+        end = self.bounds[i + 1] if i + 1 < len(self.bounds) else None
+        self.found_blocks.append((self.bounds[i], end, parts))
+        return [block for _, block in parts] or [_EMPTY_BLOCK]
+
+
+VIEW_BUILDS = ('eager', 'lazy', 'background')
+
+
+class _Build:
+    # A view that is yet to be built
+    def __init__(self):
+        self.claimed = False
+        self.queue = None
+        self.ready = threading.Event()
+        self.error = None
+
+    def enqueue(self, ids):
+        if self.queue is not None:
+            self.queue.update(ids)
+
+
+ALL_DOCS = '_all_docs'
+
+
+def _all_docs_map(o):
+    return _id_from_json(o['_id']), {'rev': o['_rev']}
+
+
+def _map_partition(task):
+    # Runs in a worker process of a parallel reindex
+    scan_partition, partition, maps = task
+    rows = {name: [] for name in maps.keys()}
+    count = 0
+    for o in scan_partition(partition):
+        for name, fn in maps.items():
+            rows[name].extend(_map(fn, o))
+        count += 1
+    return count, rows
+
+
+def _map(fn, o):
+    rows = fn(o)
+    if rows is None:
+        return
+    if not hasattr(rows, '__next__'):
+        rows = rows,
+    for k, v in rows:
+        yield _entry(o['_id'], k, v)
+
+
+def _entry(id, k, v):
+    return Row(collate(k) + _LOW + _collate(id), id, k, v)
+
+
+class Row:
+    # A view row. There can be a great many of them, so they have no
+    # __dict__ and only become dicts when handed out by view()
+    __slots__ = ('sort_key', 'id', 'key', 'value')
+
+    def __init__(self, sort_key, id=None, key=None, value=None):
+        self.sort_key = sort_key
+        self.id = id
+        self.key = key
+        self.value = value
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'key': self.key,
+            'value': self.value,
+        }
+
+    def __reduce__(self):
+        return Row, (self.sort_key, self.id, self.key, self.value)
+
+    def __repr__(self):
+        return 'Row(id=%r, key=%r, value=%r)' % (self.id, self.key, self.value)
+
+
+def _probe(key, id, bound):
+    if id is None:
+        return collate(key) + bound
+    return collate(key) + _LOW + _collate(id)
+
+
+VIEW_FORMAT = 1
+
+
+class _FrozenView:
+    # A frozen view with the changes made since laid over it: the rows of
+    # changed documents are masked in the file, and their new rows kept
+    # in memory. It can be used like the sorted list of a view.
+
+    def __init__(self, index, delta=None, masked=None, masked_ids=None):
+        self.index = index
+        self.delta = blist.sortedlist(key=entry_key) if delta is None else delta
+        # row numbers in the file that are no longer part of the view
+        self.masked = blist.sortedlist() if masked is None else masked
+        self.masked_ids = set() if masked_ids is None else masked_ids
+
+    def snapshot(self):
+        return _FrozenView(self.index, blist.sortedlist(self.delta, key=entry_key),
+                           blist.sortedlist(self.masked), self.masked_ids)
+
+    def mask(self, id_key):
+        if id_key in self.masked_ids:
+            return []
+        self.masked_ids.add(id_key)
+        numbers = self.index.postings(id_key)
+        self.masked.update(numbers)
+        return [self._frozen_row(number) for number in numbers]
+
+    def frozen_rows(self, id_key):
+        if id_key in self.masked_ids:
+            return []
+        return [self._frozen_row(number) for number in self.index.postings(id_key)]
+
+    def add(self, v):
+        self.delta.add(v)
+
+    def update(self, entries):
+        self.delta.update(entries)
+
+    def remove(self, v):
+        self.delta.remove(v)
+
+    def __len__(self):
+        return len(self.index) - len(self.masked) + len(self.delta)
+
+    def __iter__(self):
+        return self.iterate(0, len(self))
+
+    def bisect_left(self, probe):
+        number = self.index.bisect_left(probe.sort_key)
+        return number - self.masked.bisect_left(number) + self.delta.bisect_left(probe)
+
+    def bisect_right(self, probe):
+        number = self.index.bisect_right(probe.sort_key)
+        return number - self.masked.bisect_left(number) + self.delta.bisect_right(probe)
+
+    def __getitem__(self, position):
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError('view index out of range')
+        frozen, delta = self._split(position)
+        return next(self._merge(frozen, delta))
+
+    def iterate(self, start, end):
+        if start >= end:
+            return iter(())
+        frozen, delta = self._split(start)
+        return itertools.islice(self._merge(frozen, delta), end - start)
+
+    def _frozen_row(self, number):
+        id, key, value = pickle.loads(self.index.payload(number))
+        return Row(self.index.sort_key(number), id, key, value)
+
+    def _frozen_count(self):
+        return len(self.index) - len(self.masked)
+
+    def _number(self, k):
+        # The row number in the file of the k:th row that is not masked
+        lo, hi = k, k + len(self.masked)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if mid + 1 - self.masked.bisect_right(mid) > k:
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    def _split(self, position):
+        # How many of the rows before position come from the file (k) and
+        # from memory (position - k)
+        lo = max(0, position - len(self.delta))
+        hi = min(position, self._frozen_count())
+        while lo < hi:
+            k = (lo + hi) // 2
+            if self.delta[position - k - 1].sort_key > self.index.sort_key(self._number(k)):
+                lo = k + 1
+            else:
+                hi = k
+        return lo, position - lo
+
+    def _merge(self, k, j):
+        count = self._frozen_count()
+        number = self._number(k) if k < count else None
+        while True:
+            v = self.delta[j] if j < len(self.delta) else None
+            if number is not None and (v is None or self.index.sort_key(number) < v.sort_key):
+                yield self._frozen_row(number)
+                k += 1
+                number += 1
+                if k >= count:
+                    number = None
+                else:
+                    while number in self.masked:
+                        number += 1
+            elif v is not None:
+                yield v
+                j += 1
+            else:
+                return
+
+
+def _key_ranges(view_data, keys):
+    # Look the keys up in index order, each key once, and hand the
+    # ranges back in the order they were asked for
+    ranges = dict()
+    for collated in sorted({collate(key) for key in keys}):
+        ranges[collated] = _index_range(view_data, (collated + _LOW, collated + _HIGH))
+    return [ranges[collate(key)] for key in keys]
+
+
+def _bounds(key=any, startkey=None, endkey=any, startkey_docid=None, endkey_docid=None):
+    # The lowest and highest sort key of a query (None for an open end),
+    # or None if the query can have no rows
+    if key is not any:
+        return _probe(key, None, _LOW), _probe(key, None, _HIGH)
+    if startkey is any or endkey is None:
+        return None
+    low = None if startkey is None else _probe(startkey, startkey_docid, _LOW)
+    high = None if endkey is any else _probe(endkey, endkey_docid, _HIGH)
+    return low, high
+
+
+def _index_range(view_data, bounds):
+    if bounds is None:
+        return 0, 0
+    low, high = bounds
+    start = 0 if low is None else view_data.bisect_left(Row(low))
+    end = len(view_data) if high is None else view_data.bisect_right(Row(high))
+    return start, end
+
+
+def _within(sort_key, bounds):
+    low, high = bounds
+    return (low is None or low <= sort_key) and (high is None or sort_key <= high)
+
+
+def _snapshot(view_data):
+    if isinstance(view_data, _FrozenView):
+        return view_data.snapshot()
+    return blist.sortedlist(view_data, key=entry_key)
+
+
+def _rows(view_data, start, end):
+    if isinstance(view_data, _FrozenView):
+        return view_data.iterate(start, end)
+    return (view_data[index] for index in range(start, end))
+
+
+_ADDRESS = re.compile(r' at 0x[0-9a-fA-F]+')
+
+
+def _fingerprint(fn, unstable=None):
+    # Functions found in closures and defaults are fingerprinted by their
+    # code. Any other value goes by its repr, with memory addresses left
+    # out, and is passed to unstable if it had one, as a change to such a
+    # value can not be seen.
+    h = hashlib.sha1()
+    seen = set()
+
+    def feed(code):
+        h.update(code.co_code)
+        h.update(repr(code.co_names).encode('utf8'))
+        for const in code.co_consts:
+            if hasattr(const, 'co_code'):
+                feed(const)
+            else:
+                h.update(repr(const).encode('utf8'))
+
+    def feed_function(fn):
+        if id(fn) in seen:
+            return
+        seen.add(id(fn))
+        feed(fn.__code__)
+        for value in fn.__defaults__ or ():
+            feed_value(value)
+        for name, value in sorted((fn.__kwdefaults__ or {}).items()):
+            h.update(name.encode('utf8'))
+            feed_value(value)
+        for cell in fn.__closure__ or ():
+            try:
+                value = cell.cell_contents
+            except ValueError:
+                continue
+            feed_value(value)
+
+    def feed_value(value):
+        if hasattr(value, '__code__'):
+            feed_function(value)
+            return
+        text, count = _ADDRESS.subn('', repr(value))
+        if count and unstable is not None:
+            unstable(value)
+        h.update(text.encode('utf8'))
+
+    if hasattr(fn, '__code__'):
+        feed_function(fn)
+    else:
+        feed_value(fn)
+    return h.hexdigest()
+
+
+def _id_from_json(id):
+    if isinstance(id, list):
+        return tuple(_id_from_json(x) for x in id)
+    return id
+
+
+_POLL_INTERVAL = 0.1
+
+
+def _seek_changes(path, since, end):
+    # The sequence numbers grow through the file, so the place of the
+    # first change after since can be bisected on byte offsets. The
+    # changes are read from the returned offset, which is never past it.
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return 0
+    with f:
+        lo, hi = 0, end
+        while hi - lo > 4096:
+            mid = (lo + hi) // 2
+            f.seek(mid)
+            f.readline()
+            start = f.tell()
+            line = f.readline()
+            try:
+                seq = json.loads(line.decode('utf8'))['seq']
+            except ValueError:
+                seq = None
+            if start >= hi or seq is None or seq > since:
+                hi = mid
+            else:
+                lo = start + len(line)
+        return lo
+
+
+def _read_last_seq(path):
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return 0
+    with f:
+        end = f.seek(0, os.SEEK_END)
+        block = 4096
+        while True:
+            start = max(0, end - block)
+            f.seek(start)
+            lines = f.read(end - start).split(b'\n')
+            # first line may be cut by the block, last one is empty or torn
+            for line in reversed(lines[1 if start else 0:-1]):
+                try:
+                    return json.loads(line.decode('utf8'))['seq']
+                except ValueError:
+                    continue
+            if start == 0:
+                return 0
+            block *= 2
+
+
+# Keys are encoded to bytes which sort like the keys themselves, so that
+# the views can compare them natively:
+#
+#   None < numbers < strings < tuples/lists < anything else < any
+#
+# A tuple key is the concatenation of its elements, so that (2,) sorts
+# before (2, 1). The rows are sorted by key and then by document id,
+# which follows the key after a zero byte.
+
+_LOW = b'\x00'
+_HIGH = b'\x00\xff'
+_NONE = b'\x01'
+_NUMBER = b'\x02'
+_STRING = b'\x03'
+_ARRAY = b'\x04'
+_OTHER = b'\x05'
+_ANY = b'\xff'
+_DOUBLE = struct.Struct('>d')
+
+
+def collate(key):
+    if isinstance(key, tuple):
+        return b''.join(_collate(x) for x in key)
+    return _collate(key)
+
+
+def _collate(x):
+    if x is None:
+        return _NONE
+    elif isinstance(x, str):
+        return _STRING + _collate_string(x)
+    elif isinstance(x, (int, float)):
+        return _NUMBER + _collate_number(x)
+    elif isinstance(x, (tuple, list)):
+        return _ARRAY + b''.join(_collate(y) for y in x) + _LOW
+    elif x is any:
+        return _ANY
+    else:
+        return _OTHER + _collate_string(str(x))
+
+
+def _collate_string(s):
+    return s.encode('utf8').replace(b'\x00', b'\x00\xff') + b'\x00\x00'
+
+
+def _collate_number(n):
+    try:
+        n = float(n)
+    except OverflowError:
+        n = float('inf') if n > 0 else float('-inf')
+    if n == 0:
+        n = 0.0
+    b = bytearray(_DOUBLE.pack(n))
+    if b[0] & 0x80:
+        return bytes(0xff - x for x in b)
+    b[0] |= 0x80
+    return bytes(b)
+
+
+entry_key = operator.attrgetter('sort_key')
+
+
 def view_key(value):
-    return Key(value['key']), Optional(value.get('id'))
+    return collate(value['key']) + _LOW + _collate(value['id'])
 
 
 def Key(key):
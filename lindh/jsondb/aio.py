@@ -0,0 +1,122 @@
+import asyncio
+import functools
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from . import Database, _id_from_json
+
+
+class AsyncDatabase:
+    # Runs the blocking Database calls in a bounded pool of threads, so
+    # that file I/O and waiting for the lock never stall the event loop.
+
+    def __init__(self, root=None, max_workers=8, batch_size=100, **kwargs):
+        # a database made here is closed by close(), one passed in is left
+        # to its owner
+        self._owns_database = not isinstance(root, Database)
+        if self._owns_database:
+            self.database = Database(root, **kwargs)
+        else:
+            self.database = root
+        self.batch_size = batch_size
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='jsondb-io')
+
+    async def _run(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(fn, *args, **kwargs))
+
+    async def get(self, id):
+        return await self._run(self.database.get, id)
+
+    async def has(self, id):
+        return await self._run(self.database.has, id)
+
+    async def save(self, o):
+        return await self._run(self.database.save, o)
+
+    async def save_many(self, docs):
+        return await self._run(self.database.save_many, docs)
+
+    async def delete(self, id):
+        return await self._run(self.database.delete, id)
+
+    async def delete_many(self, ids):
+        return await self._run(self.database.delete_many, ids)
+
+    async def define(self, view_name, map_fn, reduce_fn=None, version=None):
+        return await self._run(self.database.define, view_name, map_fn,
+                               reduce_fn=reduce_fn, version=version)
+
+    async def create_index(self, *fields, name=None):
+        return await self._run(self.database.create_index, *fields, name=name)
+
+    async def drop_index(self, name):
+        return await self._run(self.database.drop_index, name)
+
+    async def reindex(self, **kwargs):
+        return await self._run(self.database.reindex, **kwargs)
+
+    async def checkpoint(self, **kwargs):
+        return await self._run(self.database.checkpoint, **kwargs)
+
+    async def sync(self):
+        return await self._run(self.database.sync)
+
+    async def clear(self):
+        return await self._run(self.database.clear)
+
+    def cache_info(self):
+        return self.database.cache_info()
+
+    async def view(self, view_name, include_docs=False, **kwargs):
+        rows = self.database.view(view_name, **kwargs)
+        while True:
+            batch = await self._run(list, itertools.islice(rows, self.batch_size))
+            if not batch:
+                return
+            if include_docs:
+                # Fetch the documents of the whole batch at once, each
+                # document only once even if it has several rows
+                ids = list({_id_from_json(v['id']): v['id'] for v in batch}.values())
+                docs = await asyncio.gather(*(self._get_or_none(id) for id in ids))
+                docs = dict(zip((_id_from_json(id) for id in ids), docs))
+                for v in batch:
+                    v['doc'] = docs[_id_from_json(v['id'])]
+            for v in batch:
+                yield v
+
+    async def changes(self, since=0, **kwargs):
+        changes = self.database.changes(since, **kwargs)
+        while True:
+            batch = await self._run(list, itertools.islice(changes, self.batch_size))
+            if not batch:
+                return
+            for change in batch:
+                yield change
+
+    async def wait_for_change(self, since, timeout=None):
+        return await self._run(self.database.wait_for_change, since, timeout=timeout)
+
+    async def _get_or_none(self, id):
+        try:
+            return await self.get(id)
+        except KeyError:
+            # deleted after the view snapshot was taken
+            return None
+
+    async def close(self):
+        if self._owns_database and not self.database._closed:
+            await self._run(self.database.close)
+        await asyncio.get_running_loop().run_in_executor(
+            None, self._executor.shutdown)
+
+    async def destroy(self):
+        await self._run(self.database.destroy)
+        await self.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, tb):
+        await self.close()
@@ -0,0 +1,85 @@
+import sys
+import threading
+import collections
+
+
+CacheInfo = collections.namedtuple(
+    'CacheInfo', ['hits', 'misses', 'size', 'bytes', 'maxsize', 'maxbytes'])
+
+
+class LRUCache:
+    def __init__(self, maxsize=None, maxbytes=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key):
+        with self._lock:
+            try:
+                o, size = self._data[key]
+            except KeyError:
+                self._misses += 1
+                raise
+            self._data.move_to_end(key)
+            self._hits += 1
+            return o
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def put(self, key, o):
+        size = sizeof(o) if self.maxbytes is not None else 0
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            if self.maxbytes is not None and size > self.maxbytes:
+                return
+            self._data[key] = (o, size)
+            self._bytes += size
+            while (self.maxsize is not None and len(self._data) > self.maxsize) or \
+                    (self.maxbytes is not None and self._bytes > self.maxbytes):
+                _, (_, evicted) = self._data.popitem(last=False)
+                self._bytes -= evicted
+
+    def discard(self, key):
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def info(self):
+        with self._lock:
+            return CacheInfo(self._hits, self._misses, len(self._data),
+                             self._bytes, self.maxsize, self.maxbytes)
+
+
+def sizeof(o):
+    size = sys.getsizeof(o)
+    if isinstance(o, dict):
+        for k, v in o.items():
+            size += sizeof(k) + sizeof(v)
+    elif isinstance(o, (list, tuple)):
+        for v in o:
+            size += sizeof(v)
+    return size
+
+
+def copy(o):
+    # Documents are plain JSON, which is much quicker to copy than
+    # with copy.deepcopy
+    if isinstance(o, dict):
+        return {k: copy(v) for k, v in o.items()}
+    elif isinstance(o, list):
+        return [copy(v) for v in o]
+    return o
@@ -0,0 +1,57 @@
+import json
+import zlib
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# JSON text never starts with a zero byte, so the binary codecs mark
+# their data with one and any document can be decoded without knowing
+# which codec wrote it
+_ZLIB = b'\x00Z'
+_MSGPACK = b'\x00M'
+
+
+def _json_pretty(o):
+    return json.dumps(o, indent=2).encode('utf8')
+
+
+def _json(o):
+    return json.dumps(o, separators=(',', ':')).encode('utf8')
+
+
+def _json_zlib(o):
+    return _ZLIB + zlib.compress(_json(o))
+
+
+def _msgpack(o):
+    return _MSGPACK + msgpack.packb(o, use_bin_type=True)
+
+
+ENCODERS = {
+    'json-pretty': _json_pretty,
+    'json': _json,
+    'json-zlib': _json_zlib,
+    'msgpack': _msgpack,
+}
+CODECS = tuple(ENCODERS.keys())
+DEFAULT = 'json'
+
+
+def encoder(codec):
+    if codec not in ENCODERS:
+        raise ValueError('codec must be one of ' + ', '.join(CODECS))
+    if codec == 'msgpack' and msgpack is None:
+        raise RuntimeError('The msgpack codec needs the msgpack package')
+    return ENCODERS[codec]
+
+
+def decode(data):
+    if data[:2] == _ZLIB:
+        return json.loads(zlib.decompress(data[2:]).decode('utf8'))
+    if data[:2] == _MSGPACK:
+        if msgpack is None:
+            raise RuntimeError('Reading this document needs the msgpack package')
+        return msgpack.unpackb(data[2:], raw=False)
+    return json.loads(data.decode('utf8'))
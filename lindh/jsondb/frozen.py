@@ -0,0 +1,130 @@
+import os
+import json
+import mmap
+import struct
+
+
+# A frozen view is a read-only file of rows sorted by their sort key,
+# which is memory-mapped so that processes using the same view share
+# the pages. It holds, in order:
+#
+#   magic, header length, header (JSON)
+#   row table: data offset, sort key length, payload length per row
+#   id table: data offset, id length, first posting, postings per id,
+#             sorted by id
+#   postings: the row numbers of each id
+#   data: sort keys, payloads and ids
+#
+# The sort keys and ids are bytes which compare like the keys, and the
+# payloads are opaque to this module.
+
+_MAGIC = b'JSONDBF1'
+_HEAD = struct.Struct('>8sI')
+_ROW = struct.Struct('>QII')
+_ID = struct.Struct('>QIII')
+_POSTING = struct.Struct('>I')
+
+
+def write_frozen(path, header, rows):
+    # rows are (sort key, id, payload) tuples in sort key order
+    row_table = []
+    parts = []
+    size = 0
+    ids = dict()
+    for number, (sort_key, id_key, payload) in enumerate(rows):
+        row_table.append(_ROW.pack(size, len(sort_key), len(payload)))
+        parts.append(sort_key)
+        parts.append(payload)
+        size += len(sort_key) + len(payload)
+        ids.setdefault(id_key, []).append(number)
+
+    id_table = []
+    postings = []
+    for id_key in sorted(ids.keys()):
+        numbers = ids[id_key]
+        id_table.append(_ID.pack(size, len(id_key), len(postings), len(numbers)))
+        parts.append(id_key)
+        size += len(id_key)
+        postings.extend(numbers)
+
+    header = dict(header, rows=len(row_table), ids=len(id_table), postings=len(postings))
+    head = json.dumps(header).encode('utf8')
+    tmp_path = '%s.%i.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEAD.pack(_MAGIC, len(head)) + head)
+        f.write(b''.join(row_table))
+        f.write(b''.join(id_table))
+        f.write(struct.pack('>%iI' % len(postings), *postings))
+        for part in parts:
+            f.write(part)
+    os.replace(tmp_path, path)
+
+
+class FrozenIndex:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, length = _HEAD.unpack_from(self._mm, 0)
+        if magic != _MAGIC:
+            self._mm.close()
+            raise ValueError('Not a frozen view: ' + path)
+        self.header = json.loads(self._mm[_HEAD.size:_HEAD.size + length].decode('utf8'))
+        self._count = self.header['rows']
+        self._id_count = self.header['ids']
+        self._rows_at = _HEAD.size + length
+        self._ids_at = self._rows_at + self._count * _ROW.size
+        self._postings_at = self._ids_at + self._id_count * _ID.size
+        self._data_at = self._postings_at + self.header['postings'] * _POSTING.size
+
+    def __len__(self):
+        return self._count
+
+    def sort_key(self, number):
+        offset, key_length, _ = _ROW.unpack_from(self._mm, self._rows_at + number * _ROW.size)
+        start = self._data_at + offset
+        return self._mm[start:start + key_length]
+
+    def payload(self, number):
+        offset, key_length, length = _ROW.unpack_from(self._mm, self._rows_at + number * _ROW.size)
+        start = self._data_at + offset + key_length
+        return self._mm[start:start + length]
+
+    def bisect_left(self, sort_key):
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.sort_key(mid) < sort_key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def bisect_right(self, sort_key):
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if sort_key < self.sort_key(mid):
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    def postings(self, id_key):
+        # The row numbers of an id, in order
+        lo, hi = 0, self._id_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset, length, first, count = _ID.unpack_from(self._mm, self._ids_at + mid * _ID.size)
+            start = self._data_at + offset
+            this_key = self._mm[start:start + length]
+            if this_key == id_key:
+                return list(struct.unpack_from(
+                    '>%iI' % count, self._mm, self._postings_at + first * _POSTING.size))
+            if this_key < id_key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return []
+
+    def close(self):
+        self._mm.close()
@@ -0,0 +1,82 @@
+import operator
+
+
+MISSING = object()
+
+
+def compile_path(path):
+    # A dotted path like 'engine.power' becomes a function that takes a
+    # document and returns the value there, raising KeyError (or
+    # TypeError) where the path does not lead anywhere
+    getters = [operator.itemgetter(part) for part in path.split('.')]
+    if len(getters) == 1:
+        return getters[0]
+
+    def get(o):
+        for getter in getters:
+            o = getter(o)
+        return o
+    return get
+
+
+class FieldIndex:
+    # The map function of an index on the fields of the documents. The
+    # key is the value of the field, or a tuple of the values if there are
+    # several, and documents that lack any of the fields are left out.
+    # Being an object rather than a function, it can be compared, stored
+    # and sent to other processes.
+
+    def __init__(self, fields):
+        self.fields = tuple(fields)
+        if not self.fields or not all(isinstance(field, str) and field for field in self.fields):
+            raise ValueError('fields must be one or more dotted paths')
+        if all('.' not in field for field in self.fields):
+            # one getter fetches them all, as a tuple if there are several
+            self._get = operator.itemgetter(*self.fields)
+        elif len(self.fields) == 1:
+            self._get = compile_path(self.fields[0])
+        else:
+            getters = [compile_path(field) for field in self.fields]
+            self._get = lambda o: tuple(getter(o) for getter in getters)
+
+    def key(self, o):
+        # The key of a document, or MISSING if it is not in the index
+        try:
+            return self._get(o)
+        except (KeyError, TypeError):
+            return MISSING
+
+    def unchanged(self, old, new):
+        # True if the rows of the new version of a document are the same
+        # as those of the old one
+        return _same(self.key(old), self.key(new))
+
+    def __call__(self, o):
+        key = self.key(o)
+        if key is MISSING:
+            return None
+        return key, None
+
+    def __reduce__(self):
+        return FieldIndex, (self.fields,)
+
+    def __eq__(self, other):
+        return isinstance(other, FieldIndex) and self.fields == other.fields
+
+    def __hash__(self):
+        return hash(self.fields)
+
+    def __repr__(self):
+        return 'FieldIndex(%r)' % (self.fields,)
+
+
+def _same(a, b):
+    # Equal and of the same types all the way down, as 1 == 1.0 == True
+    # but the rows should give back the key as it is now
+    if type(a) is not type(b):
+        return False
+    if isinstance(a, (tuple, list)):
+        return len(a) == len(b) and all(_same(x, y) for x, y in zip(a, b))
+    if isinstance(a, dict):
+        return a.keys() == b.keys() and all(_same(a[k], b[k]) for k in a.keys())
+    return a == b
@@ -0,0 +1,116 @@
+import threading
+import contextlib
+import collections
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class ReadWriteLock:
+    # Used as a context manager it is taken for writing, which is what
+    # most of the database needs. Threads that have to wait are let in
+    # in the order they came, readers at the head of the line together,
+    # so that neither a steady stream of readers nor a writer that takes
+    # the lock again and again can starve the others.
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waiting = collections.deque()
+
+    def acquire_read(self):
+        with self._cond:
+            if not self._writer and not self._waiting:
+                self._readers += 1
+                return
+            turn = object()
+            self._waiting.append(turn)
+            while self._waiting[0] is not turn or self._writer:
+                self._cond.wait()
+            self._waiting.popleft()
+            self._readers += 1
+            # a reader next in line may come in too
+            self._cond.notify_all()
+
+    def release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if self._readers == 0:
+                self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def read(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    def acquire(self):
+        with self._cond:
+            if not self._writer and not self._readers and not self._waiting:
+                self._writer = True
+                return
+            turn = object()
+            self._waiting.append(turn)
+            while self._waiting[0] is not turn or self._writer or self._readers:
+                self._cond.wait()
+            self._waiting.popleft()
+            self._writer = True
+
+    def release(self):
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.release()
+
+
+class FileLock:
+    # An advisory lock on a file, for processes sharing a database. The
+    # shared mode is counted, as flock() locks belong to the open file
+    # and not to the thread that took them.
+
+    def __init__(self, path):
+        if fcntl is None:
+            raise RuntimeError('File locking needs fcntl, which this platform lacks')
+        self._fp = open(path, 'a+b')
+        self._mutex = threading.Lock()
+        self._shared = 0
+
+    def acquire(self):
+        fcntl.flock(self._fp.fileno(), fcntl.LOCK_EX)
+
+    def release(self):
+        fcntl.flock(self._fp.fileno(), fcntl.LOCK_UN)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.release()
+
+    @contextlib.contextmanager
+    def shared(self):
+        with self._mutex:
+            if self._shared == 0:
+                fcntl.flock(self._fp.fileno(), fcntl.LOCK_SH)
+            self._shared += 1
+        try:
+            yield
+        finally:
+            with self._mutex:
+                self._shared -= 1
+                if self._shared == 0:
+                    fcntl.flock(self._fp.fileno(), fcntl.LOCK_UN)
+
+    def close(self):
+        self._fp.close()
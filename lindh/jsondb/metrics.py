@@ -0,0 +1,156 @@
+import os
+import time
+import bisect
+import threading
+import functools
+import contextlib
+
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005,
+           0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics:
+    # Counters and timing histograms, kept by name and labels. Every
+    # event is also passed on to the sink, if there is one, as
+    # sink(kind, name, value, labels) where kind is 'count' or 'time'.
+
+    def __init__(self, sink=None, buckets=BUCKETS):
+        self.sink = sink
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = dict()
+        self._histograms = dict()
+
+    def count(self, name, value=1, **labels):
+        key = name, tuple(sorted(labels.items()))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        if self.sink is not None:
+            self.sink('count', name, value, labels)
+
+    def observe(self, name, seconds, **labels):
+        key = name, tuple(sorted(labels.items()))
+        with self._lock:
+            try:
+                histogram = self._histograms[key]
+            except KeyError:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(seconds)
+        if self.sink is not None:
+            self.sink('time', name, seconds, labels)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t0, **labels)
+
+    def timed(self, fn, name, **labels):
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            with self.timer(name, **labels):
+                return fn(*args, **kwargs)
+        return timed
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': {_format_name(name, labels): value
+                             for (name, labels), value in self._counters.items()},
+                'timers': {_format_name(name, labels): {'count': h.count, 'sum': h.sum}
+                           for (name, labels), h in self._histograms.items()},
+            }
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def prometheus(self, prefix='jsondb_'):
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                lines.append('%s%s_total%s %s' % (prefix, name, _format_labels(labels), value))
+            for (name, labels), h in sorted(self._histograms.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), h.counts):
+                    cumulative += count
+                    lines.append('%s%s_bucket%s %i' % (
+                        prefix, name, _format_labels(labels + (('le', bound),)), cumulative))
+                lines.append('%s%s_sum%s %r' % (prefix, name, _format_labels(labels), h.sum))
+                lines.append('%s%s_count%s %i' % (prefix, name, _format_labels(labels), h.count))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path, prefix='jsondb_'):
+        # For the textfile collector of the node exporter, which must never
+        # see half a file
+        tmp_path = '%s.%i.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(self.prometheus(prefix=prefix))
+        os.replace(tmp_path, path)
+
+
+class NullMetrics:
+    # Used when metrics are off, and costs next to nothing
+
+    sink = None
+
+    def count(self, name, value=1, **labels):
+        pass
+
+    def observe(self, name, seconds, **labels):
+        pass
+
+    def timer(self, name, **labels):
+        return _NULL_TIMER
+
+    def timed(self, fn, name, **labels):
+        return fn
+
+
+_NULL_TIMER = contextlib.nullcontext()
+NULL_METRICS = NullMetrics()
+
+
+def statsd_sink(write, prefix='jsondb.'):
+    # Formats each event as a statsd line (with tags the way DogStatsD
+    # reads them) and passes it to write, for instance the send method
+    # of a UDP socket or the write method of a file
+    def sink(kind, name, value, labels):
+        if kind == 'time':
+            line = '%s%s:%.3f|ms' % (prefix, name, value * 1000)
+        else:
+            line = '%s%s:%s|c' % (prefix, name, value)
+        if labels:
+            line += '|#' + ','.join('%s:%s' % item for item in sorted(labels.items()))
+        write(line.encode('utf8') + b'\n')
+    return sink
+
+
+def _format_name(name, labels):
+    return name + _format_labels(labels)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in labels)
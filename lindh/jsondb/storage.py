@@ -0,0 +1,378 @@
+import os
+import json
+import struct
+import shutil
+import hashlib
+import threading
+import zlib
+from .metrics import NULL_METRICS
+from .codec import encoder, decode
+
+
+class FileStorage:
+    metrics = NULL_METRICS
+    encode = staticmethod(encoder('json-pretty'))
+
+    def __init__(self, root, filename_hasher=None):
+        self.root = root
+        self.folder = os.path.join(root, 'objects')
+        self._filename_hasher = filename_hasher or self._default_filename_hasher
+        os.makedirs(self.folder, exist_ok=True)
+
+    def _get_object_filename(self, id):
+        return self._filename_hasher(id)
+
+    def _default_filename_hasher(self, id):
+        hash_name = hashlib.sha224(str(id).encode('utf8')).hexdigest()
+        return os.path.join(hash_name[:2], hash_name[2:] + '.json')
+
+    def _path(self, id):
+        return os.path.join(self.folder, self._get_object_filename(id))
+
+    def exists(self, id):
+        return os.path.exists(self._path(id))
+
+    def read(self, id):
+        try:
+            with self.metrics.timer('io_seconds', op='read'):
+                with open(self._path(id), 'rb') as f:
+                    data = f.read()
+        except FileNotFoundError:
+            raise KeyError('Key does not exist: ' + str(id))
+        self.metrics.count('io_bytes', len(data), op='read')
+        with self.metrics.timer('json_seconds', op='decode'):
+            return decode(data)
+
+    def write(self, id, o):
+        path = self._path(id)
+        with self.metrics.timer('json_seconds', op='encode'):
+            data = self.encode(o)
+        with self.metrics.timer('io_seconds', op='write'):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write aside and rename, so that a crash never leaves half a file
+            tmp_path = '%s.%i.tmp' % (path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        self.metrics.count('io_bytes', len(data), op='write')
+
+    def remove(self, id):
+        try:
+            os.remove(self._path(id))
+        except FileNotFoundError:
+            raise KeyError('Key does not exist: ' + str(id))
+
+    def scan(self):
+        for partition in self.partitions():
+            yield from self.scan_partition(partition)
+
+    def partitions(self):
+        # Each entry directly under objects, usually one of the 256 hash
+        # prefix folders, can be scanned on its own by another process
+        return sorted(os.path.join(self.folder, name)
+                      for name in os.listdir(self.folder))
+
+    @staticmethod
+    def scan_partition(partition):
+        if os.path.isdir(partition):
+            paths = (os.path.join(r, f)
+                     for r, ds, fs in os.walk(partition) for f in fs)
+        else:
+            paths = partition,
+        for path in paths:
+            if path.endswith('.json'):
+                try:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                except FileNotFoundError:
+                    # deleted while we were scanning
+                    continue
+                yield decode(data)
+
+    def sync(self):
+        if hasattr(os, 'sync'):
+            os.sync()
+            return
+        for r, ds, fs in os.walk(self.folder):
+            for f in fs:
+                with open(os.path.join(r, f), 'rb+') as f:
+                    os.fsync(f.fileno())
+
+    def clear(self):
+        shutil.rmtree(self.folder)
+        os.makedirs(self.folder, exist_ok=True)
+
+    def close(self):
+        pass
+
+
+# Record layout: crc32, flag, key length, value length, key, value.
+# The crc covers everything after itself.
+_HEADER = struct.Struct('>IBII')
+_PUT = 1
+_DELETE = 2
+_COMPACTED = 3
+
+
+class LogStorage:
+    metrics = NULL_METRICS
+    encode = staticmethod(encoder('json'))
+
+    def __init__(self, root, segment_size=64 * 1024 * 1024,
+                 compact_ratio=0.5, background=True):
+        self.root = root
+        self.folder = os.path.join(root, 'log')
+        self.segment_size = segment_size
+        self.compact_ratio = compact_ratio
+        self.background = background
+        self._lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+        self._compacting = None
+        os.makedirs(self.folder, exist_ok=True)
+        self._open()
+
+    def _segment_path(self, number):
+        return os.path.join(self.folder, 'segment-%08i.log' % number)
+
+    def _segment_numbers(self):
+        return sorted(
+            int(f[8:-4]) for f in os.listdir(self.folder)
+            if f.startswith('segment-') and f.endswith('.log')
+        )
+
+    def _open(self):
+        self._index = dict()
+        self._files = dict()
+        self._total_bytes = 0
+        self._live_bytes = 0
+
+        numbers = self._segment_numbers()
+        # A compacted segment supersedes every segment before it, some of
+        # which may be left behind if we crashed while compacting.
+        for number in reversed(numbers):
+            if self._is_compacted(number):
+                for older in numbers[:numbers.index(number)]:
+                    os.remove(self._segment_path(older))
+                numbers = numbers[numbers.index(number):]
+                break
+
+        for number in numbers:
+            self._load_segment(number)
+
+        self._active = numbers[-1] if numbers else 1
+        if not numbers:
+            self._files[self._active] = open(self._segment_path(self._active), 'a+b')
+        self._active_fp = self._files[self._active]
+        self._active_fp.seek(0, os.SEEK_END)
+
+    def _is_compacted(self, number):
+        with open(self._segment_path(number), 'rb') as f:
+            header = f.read(_HEADER.size)
+        return len(header) == _HEADER.size and _HEADER.unpack(header)[1] == _COMPACTED
+
+    def _load_segment(self, number):
+        path = self._segment_path(number)
+        fp = open(path, 'a+b')
+        self._files[number] = fp
+        fp.seek(0)
+        offset = 0
+        while True:
+            header = fp.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                break
+            crc, flag, key_length, value_length = _HEADER.unpack(header)
+            rest = fp.read(key_length + value_length)
+            if len(rest) < key_length + value_length or \
+                    zlib.crc32(header[4:] + rest) != crc:
+                break
+            length = _HEADER.size + key_length + value_length
+            key = rest[:key_length]
+            if flag == _PUT:
+                self._forget(key)
+                self._index[key] = (number, offset, length)
+                self._live_bytes += length
+            elif flag == _DELETE:
+                self._forget(key)
+            offset += length
+        # Drop a torn record at the end, it was never acknowledged
+        fp.truncate(offset)
+        self._total_bytes += offset
+
+    def _forget(self, key):
+        location = self._index.pop(key, None)
+        if location is not None:
+            self._live_bytes -= location[2]
+
+    def _key(self, id):
+        return json.dumps(id).encode('utf8')
+
+    def _append(self, flag, key, value=b''):
+        head = struct.pack('>BII', flag, len(key), len(value))
+        crc = zlib.crc32(head + key + value)
+        record = struct.pack('>I', crc) + head + key + value
+        offset = self._active_fp.seek(0, os.SEEK_END)
+        if offset + len(record) > self.segment_size and offset > 0:
+            self._roll()
+            offset = 0
+        self._active_fp.write(record)
+        self._active_fp.flush()
+        self._total_bytes += len(record)
+        return self._active, offset, len(record)
+
+    def _roll(self):
+        self._active += 1
+        self._active_fp = open(self._segment_path(self._active), 'a+b')
+        self._files[self._active] = self._active_fp
+
+    def _read_record(self, location):
+        number, offset, length = location
+        fp = self._files[number]
+        fp.seek(offset)
+        record = fp.read(length)
+        _, _, key_length, value_length = _HEADER.unpack_from(record)
+        return record[_HEADER.size + key_length:]
+
+    def exists(self, id):
+        with self._lock:
+            return self._key(id) in self._index
+
+    def read(self, id):
+        with self._lock:
+            try:
+                location = self._index[self._key(id)]
+            except KeyError:
+                raise KeyError('Key does not exist: ' + str(id))
+            with self.metrics.timer('io_seconds', op='read'):
+                value = self._read_record(location)
+        self.metrics.count('io_bytes', len(value), op='read')
+        with self.metrics.timer('json_seconds', op='decode'):
+            return decode(value)
+
+    def write(self, id, o):
+        key = self._key(id)
+        with self.metrics.timer('json_seconds', op='encode'):
+            value = self.encode(o)
+        with self._lock:
+            with self.metrics.timer('io_seconds', op='write'):
+                location = self._append(_PUT, key, value)
+            self.metrics.count('io_bytes', location[2], op='write')
+            self._forget(key)
+            self._index[key] = location
+            self._live_bytes += location[2]
+            compact = self._should_compact()
+        if compact:
+            self._start_compaction()
+
+    def remove(self, id):
+        key = self._key(id)
+        with self._lock:
+            if key not in self._index:
+                raise KeyError('Key does not exist: ' + str(id))
+            self._append(_DELETE, key)
+            self._forget(key)
+            compact = self._should_compact()
+        if compact:
+            self._start_compaction()
+
+    def scan(self):
+        # Read in file order, but look each key up again as compaction
+        # may have moved it since we took the snapshot
+        with self._lock:
+            keys = [key for location, key in sorted(
+                (location, key) for key, location in self._index.items())]
+        for key in keys:
+            with self._lock:
+                location = self._index.get(key)
+                if location is None:
+                    continue
+                value = self._read_record(location)
+            yield decode(value)
+
+    def _should_compact(self):
+        if self._compacting is not None or self._total_bytes == 0:
+            return False
+        if len(self._files) < 2:
+            return False
+        garbage = self._total_bytes - self._live_bytes
+        if garbage / self._total_bytes < self.compact_ratio:
+            return False
+        self._compacting = True
+        return True
+
+    def _start_compaction(self):
+        if self.background:
+            self._compacting = threading.Thread(
+                target=self.compact, name='jsondb-compact', daemon=True)
+            self._compacting.start()
+        else:
+            self.compact()
+
+    def compact(self):
+        with self._compact_lock:
+            self._compact()
+
+    def _compact(self):
+        try:
+            with self._lock:
+                self._roll()
+                sealed = sorted(n for n in self._files if n < self._active)
+                if not sealed:
+                    return
+                target = sealed[-1]
+                live = sorted(
+                    (location, key) for key, location in self._index.items()
+                    if location[0] in sealed
+                )
+
+            tmp_path = self._segment_path(target) + '.tmp'
+            moved = []
+            with open(tmp_path, 'wb') as out:
+                head = struct.pack('>BII', _COMPACTED, 0, 0)
+                out.write(struct.pack('>I', zlib.crc32(head)) + head)
+                for location, key in live:
+                    with self._lock:
+                        fp = self._files[location[0]]
+                        fp.seek(location[1])
+                        record = fp.read(location[2])
+                    moved.append((key, location, (target, out.tell(), len(record))))
+                    out.write(record)
+                out.flush()
+                os.fsync(out.fileno())
+
+            with self._lock:
+                for number in sealed:
+                    self._files.pop(number).close()
+                os.replace(tmp_path, self._segment_path(target))
+                for number in sealed[:-1]:
+                    os.remove(self._segment_path(number))
+                self._files[target] = open(self._segment_path(target), 'a+b')
+                for key, old, new in moved:
+                    if self._index.get(key) == old:
+                        self._index[key] = new
+                self._total_bytes = sum(
+                    os.path.getsize(self._segment_path(n)) for n in self._files)
+        finally:
+            self._compacting = None
+
+    def sync(self):
+        with self._lock:
+            for fp in self._files.values():
+                os.fsync(fp.fileno())
+
+    def clear(self):
+        with self._lock:
+            self._close()
+            shutil.rmtree(self.folder)
+            os.makedirs(self.folder, exist_ok=True)
+            self._open()
+
+    def _close(self):
+        for fp in self._files.values():
+            fp.close()
+        self._files = dict()
+
+    def close(self):
+        with self._compact_lock:
+            pass
+        with self._lock:
+            self._close()
@@ -0,0 +1,90 @@
+import os
+import json
+import threading
+import zlib
+
+
+DURABILITY = ('fsync-per-write', 'group-commit', 'os-buffered')
+
+
+class WriteAheadLog:
+    # Positions in the log (lsn) keep growing when the log is truncated,
+    # so that a writer waiting for its commit is never left behind.
+
+    def __init__(self, path, durability='group-commit', size=16 * 1024 * 1024):
+        if durability not in DURABILITY:
+            raise ValueError('durability must be one of ' + ', '.join(DURABILITY))
+        self.path = path
+        self.durability = durability
+        self.size = size
+        self._fp = open(path, 'ab')
+        self._cond = threading.Condition(threading.Lock())
+        self._base = 0
+        self._written = self._fp.tell()
+        self._synced = self._written
+        self._syncing = False
+
+    def records(self):
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                crc, _, data = line[:-1].partition(b' ')
+                try:
+                    if int(crc, 16) != zlib.crc32(data):
+                        break
+                except ValueError:
+                    break
+                yield json.loads(data.decode('utf8'))
+
+    def append(self, records):
+        lines = []
+        for record in records:
+            data = json.dumps(record, separators=(',', ':')).encode('utf8')
+            lines.append(b'%08x ' % zlib.crc32(data) + data + b'\n')
+        with self._cond:
+            self._fp.write(b''.join(lines))
+            self._fp.flush()
+            if self.durability == 'fsync-per-write':
+                os.fsync(self._fp.fileno())
+            self._written = self._base + self._fp.tell()
+            if self.durability == 'fsync-per-write':
+                self._synced = self._written
+            return self._written
+
+    def commit(self, lsn):
+        if self.durability != 'group-commit':
+            return
+        with self._cond:
+            while self._synced < lsn:
+                if self._syncing:
+                    self._cond.wait()
+                    continue
+                # Become the leader and sync everything written so far,
+                # which commits the followers that arrive meanwhile too
+                self._syncing = True
+                target = self._written
+                self._cond.release()
+                try:
+                    os.fsync(self._fp.fileno())
+                finally:
+                    self._cond.acquire()
+                    self._syncing = False
+                    self._cond.notify_all()
+                self._synced = max(self._synced, target)
+
+    def full(self):
+        return self._written - self._base > self.size
+
+    def truncate(self):
+        with self._cond:
+            self._base += self._fp.tell()
+            self._fp.truncate(0)
+            self._fp.seek(0)
+            if self.durability != 'os-buffered':
+                os.fsync(self._fp.fileno())
+            self._written = self._synced = self._base
+            self._cond.notify_all()
+
+    def close(self):
+        self._fp.close()
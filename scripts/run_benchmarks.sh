@@ -0,0 +1,15 @@
+#!/bin/bash -e
+# Usage
+#   $ ./scripts/run_benchmarks.sh [results-folder] [bench.py options]
+# Runs the benchmarks for every key type and writes one JSON file per run
+# to results-folder (default benchmarks/results), named after the current
+# commit. If there are results from the previous run, they are compared.
+out=${1:-benchmarks/results}
+shift || true
+mkdir -p $out
+name=$(git rev-parse --short HEAD 2>/dev/null || date +%Y%m%d%H%M%S)
+for keys in int string tuple mixed; do
+    previous=$(ls -t $out/*-$keys.json 2>/dev/null | grep -v "/$name-" | head -n 1 || true)
+    python benchmarks/bench.py --keys $keys -o $out/$name-$keys.json \
+        ${previous:+--compare $previous} "$@"
+done
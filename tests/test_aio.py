@@ -0,0 +1,91 @@
+import os
+import asyncio
+import pytest
+import tempfile
+from lindh import jsondb
+from lindh.jsondb.aio import AsyncDatabase
+
+
+@pytest.fixture(scope='function')
+def db():
+    db = AsyncDatabase(tempfile.mkdtemp(prefix='jsondb-'), max_workers=4, batch_size=3)
+    yield db
+    asyncio.run(db.destroy())
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_get_and_save(db):
+    async def go():
+        o = await db.save({'a': 1})
+        assert o['_id'] == 0
+        assert await db.has(0)
+        assert (await db.get(0))['a'] == 1
+        with pytest.raises(jsondb.Conflict):
+            await db.save({'_id': 0, '_rev': 5})
+        await db.delete(0)
+        assert not await db.has(0)
+    run(go())
+
+
+def test_view_with_docs(db):
+    def emit_twice(o):
+        yield o['a'], None
+        yield o['a'] + 10, None
+
+    async def go():
+        await db.define('twice', emit_twice)
+        await db.save_many([{'a': a} for a in range(4)])
+        rows = [v async for v in db.view('twice', include_docs=True)]
+        assert [v['key'] for v in rows] == [0, 1, 2, 3, 10, 11, 12, 13]
+        assert [v['doc']['a'] for v in rows] == [0, 1, 2, 3, 0, 1, 2, 3]
+        rows = [v async for v in db.view('twice', startkey=2, endkey=11)]
+        assert [v['key'] for v in rows] == [2, 3, 10, 11]
+    run(go())
+
+
+def test_calls_do_not_block_the_loop(db):
+    async def go():
+        await db.define('by_a', lambda o: (o['a'], None))
+        # Hold the database lock in another thread, the loop should keep going
+        db.database._lock.acquire()
+        ticks = 0
+        saving = asyncio.ensure_future(db.save({'a': 1}))
+        while ticks < 10:
+            await asyncio.sleep(0.001)
+            ticks += 1
+        assert not saving.done()
+        db.database._lock.release()
+        await saving
+        assert [v['key'] async for v in db.view('by_a')] == [1]
+    run(go())
+
+
+def test_wraps_existing_database():
+    root = tempfile.mkdtemp(prefix='jsondb-')
+    database = jsondb.Database(root)
+    database.save({'a': 1})
+
+    async def go():
+        async with AsyncDatabase(database) as db:
+            assert db.database is database
+            assert (await db.get(0))['a'] == 1
+    run(go())
+    assert database.get(0)['a'] == 1
+    database.destroy()
+
+
+def test_closes_own_database():
+    root = tempfile.mkdtemp(prefix='jsondb-')
+
+    async def go():
+        async with AsyncDatabase(root, durability='group-commit') as db:
+            await db.save({'a': 1})
+        await db.close()
+        return db.database
+    database = run(go())
+    assert database._closed
+    assert os.path.getsize(os.path.join(root, 'wal')) == 0
+    jsondb.Database(root).destroy()
@@ -0,0 +1,42 @@
+import pytest
+import tempfile
+from lindh import jsondb
+
+
+@pytest.fixture(scope='function')
+def root():
+    root = tempfile.mkdtemp(prefix='jsondb-')
+    yield root
+    jsondb.Database(root).destroy()
+
+
+def test_all_docs_in_id_order(root):
+    db = jsondb.Database(root)
+    for id in ['b', 'a', 3, 'c', 1, ('x', 1)]:
+        db.save({'_id': id})
+    assert [v['key'] for v in db.all_docs()] == [1, 3, 'a', 'b', 'c', ('x', 1)]
+    assert [v['id'] for v in db.all_docs(startkey='a', endkey='b')] == ['a', 'b']
+    assert [v['id'] for v in db.all_docs(startkey='a', limit=2, skip=1)] == ['b', 'c']
+    assert list(db.all_docs(key=3)) == [{'id': 3, 'key': 3, 'value': {'rev': 0}}]
+
+
+def test_all_docs_follows_writes(root):
+    db = jsondb.Database(root)
+    assert list(db.all_docs()) == []
+    o = db.save({'_id': 'a'})
+    db.save({'_id': 'b'})
+    db.save(o)
+    db.delete('b')
+    rows = list(db.all_docs(include_docs=True))
+    assert rows == [{'id': 'a', 'key': 'a', 'value': {'rev': 1},
+                     'doc': {'_id': 'a', '_rev': 1}}]
+
+
+def test_all_docs_after_restart(root):
+    db = jsondb.Database(root)
+    db.save_many([{'_id': 'a'}, {'_id': 'b'}])
+    list(db.all_docs())
+    db.save({'_id': 'c'})
+
+    db = jsondb.Database(root)
+    assert [v['id'] for v in db.all_docs()] == ['a', 'b', 'c']
@@ -346,3 +346,110 @@ def test_skip_and_limit(db):
                     'doc': {'_id': 2, '_rev': 0, '2': 12}}
     assert r[1] == {'id': 5, 'key': 5, 'value': 1,
                     'doc': {'_id': 5, '_rev': 0, '5': 15}}
+
+
+def test_limit_is_applied(db):
+    db.define('by_id', lambda o: (o['_id'], 1))
+    for n in range(10):
+        db[n] = {}
+    r = list(db.view('by_id', skip=3, limit=4))
+    assert [v['id'] for v in r] == [3, 4, 5, 6]
+    r = list(db.view('by_id', skip=8, limit=4))
+    assert [v['id'] for v in r] == [8, 9]
+    assert list(db.view('by_id', limit=0)) == []
+
+
+def test_limit_within_key_range(db):
+    db.define('by_a', lambda o: (o['a'], None))
+    for a in [1, 2, 2, 2, 3]:
+        db.save({'a': a})
+    r = list(db.view('by_a', key=2, skip=1, limit=1))
+    assert r == [{'id': 2, 'key': 2, 'value': None}]
+    r = list(db.view('by_a', startkey=2, endkey=3, skip=2))
+    assert [v['id'] for v in r] == [3, 4]
+
+
+def test_startkey_docid(db):
+    db.define('by_a', lambda o: (o['a'], None))
+    for a in [1, 2, 2, 2, 3]:
+        db.save({'a': a})
+    r = list(db.view('by_a', startkey=2, startkey_docid=2, limit=2))
+    assert r == [{'id': 2, 'key': 2, 'value': None},
+                 {'id': 3, 'key': 2, 'value': None}]
+    r = list(db.view('by_a', startkey=2, startkey_docid=3, endkey=2))
+    assert r == [{'id': 3, 'key': 2, 'value': None}]
+    r = list(db.view('by_a', endkey=2, endkey_docid=2))
+    assert [v['id'] for v in r] == [0, 1, 2]
+
+
+def test_reduce_by_group_skip_and_limit(db):
+    db.define('count',
+              lambda o: (o['a'], 1),
+              lambda keys, values, rereduce: sum(values))
+    for a in [1, 2, 2, 3, 3, 3, 4]:
+        db.save({'a': a})
+    r = list(db.view('count', group=True, skip=1, limit=2))
+    assert r == [{'key': 2, 'value': 2}, {'key': 3, 'value': 3}]
+    r = list(db.view('count', group=True, skip=3))
+    assert r == [{'key': 4, 'value': 1}]
+
+
+def test_view_rows_are_copies(db):
+    db.define('by_a', lambda o: (o['a'], None))
+    db.save({'a': 1})
+    r = next(db.view('by_a'))
+    r['key'] = 2
+    assert list(db.view('by_a')) == [{'id': 0, 'key': 1, 'value': None}]
+
+
+def test_include_docs_many_rows(db):
+    def emit_twice(o):
+        yield o['a'], None
+        yield o['a'] + 1000, None
+
+    db.define('twice', emit_twice)
+    db.save_many([{'a': a} for a in range(200)])
+    rows = list(db.view('twice', include_docs=True))
+    assert [v['doc']['a'] for v in rows] == list(range(200)) * 2
+    rows[0]['doc']['a'] = -1
+    assert rows[200]['doc']['a'] == 0
+    rows = list(db.view('twice', include_docs=True, startkey=150, endkey=1010))
+    assert [v['doc']['a'] for v in rows] == list(range(150, 200)) + list(range(11))
+
+
+def test_include_docs_without_prefetch():
+    db = jsondb.Database(tempfile.mkdtemp(prefix='jsondb-'), prefetch_threads=0)
+    try:
+        db.define('by_a', lambda o: (o['a'], None))
+        db.save_many([{'a': a} for a in range(3)])
+        assert [v['doc']['a'] for v in db.view('by_a', include_docs=True)] == [0, 1, 2]
+    finally:
+        db.destroy()
+
+
+def test_view_keys(db):
+    db.define('by_a', lambda o: (o['a'], None))
+    for a in [1, 2, 2, 3, 'x', (1, 2)]:
+        db.save({'a': a})
+    r = list(db.view('by_a', keys=[3, 'x', 2, 7, (1, 2), 3]))
+    assert [(v['key'], v['id']) for v in r] == [
+        (3, 3), ('x', 4), (2, 1), (2, 2), ((1, 2), 5), (3, 3)]
+    r = list(db.view('by_a', keys=[2, 1], skip=1, limit=2, include_docs=True))
+    assert [v['doc']['_id'] for v in r] == [2, 0]
+    assert list(db.view('by_a', keys=[])) == []
+    with pytest.raises(ValueError):
+        list(db.view('by_a', keys=[1], startkey=0))
+
+
+def test_view_keys_reduce(db):
+    db.define('count',
+              lambda o: (o['a'], 1),
+              lambda keys, values, rereduce: sum(values))
+    for a in [1, 2, 2, 3, 3, 3]:
+        db.save({'a': a})
+    r = list(db.view('count', keys=[3, 5, 1], group=True))
+    assert r == [{'key': 3, 'value': 3}, {'key': 1, 'value': 1}]
+    assert list(db.view('count', keys=[3, 2])) == [{'key': None, 'value': 5}]
+    assert list(db.view('count', keys=[5])) == []
+    r = list(db.view('count', keys=[3, 1], no_reduce=True))
+    assert [v['id'] for v in r] == [3, 4, 5, 0]
@@ -0,0 +1,87 @@
+import pytest
+import tempfile
+import threading
+from lindh import jsondb
+
+
+@pytest.fixture(scope='function')
+def root():
+    root = tempfile.mkdtemp(prefix='jsondb-')
+    yield root
+    jsondb.Database(root).destroy()
+
+
+def test_lazy_view_is_built_on_first_use(root):
+    mapped = []
+
+    def by_a(o):
+        mapped.append(o['_id'])
+        return o['a'], None
+
+    db = jsondb.Database(root, view_build='lazy')
+    db.save_many([{'a': 2}, {'a': 1}])
+    db.define('by_a', by_a)
+    assert mapped == []
+    db.save({'a': 0})
+    db.delete(0)
+    assert mapped == []
+    assert [v['key'] for v in db.view('by_a')] == [0, 1]
+    assert sorted(mapped) == [1, 2]
+    db.save({'a': 3})
+    assert [v['key'] for v in db.view('by_a')] == [0, 1, 3]
+
+
+def test_lazy_view_loads_checkpoint(root):
+    db = jsondb.Database(root)
+    db.save({'a': 1})
+    db.define('by_a', lambda o: (o['a'], None))
+    db.save({'a': 2})
+
+    db = jsondb.Database(root)
+    db.define('by_a', lambda o: (o['a'], None), build='lazy')
+    assert 'by_a' not in db._view_data
+    assert [v['key'] for v in db.view('by_a')] == [1, 2]
+
+
+def test_writes_during_background_build_are_queued(root):
+    db = jsondb.Database(root)
+    db.save_many([{'a': a} for a in range(20)])
+    scanning = threading.Event()
+    go_on = threading.Event()
+
+    def by_a(o):
+        if o['_id'] == 5 and not scanning.is_set():
+            scanning.set()
+            go_on.wait(5)
+        return o['a'], None
+
+    db.define('by_a', by_a, build='background')
+    assert scanning.wait(5)
+    # the scan is held up, writes go on meanwhile
+    o = db.get(3)
+    o['a'] = 100
+    db.save(o)
+    db.delete(7)
+    db.save({'a': 50})
+    go_on.set()
+    keys = [v['key'] for v in db.view('by_a')]
+    assert keys == [a for a in range(20) if a not in (3, 7)] + [50, 100]
+    assert 'by_a' not in db._view_builds
+
+
+def test_failing_build_raises_on_view(root):
+    db = jsondb.Database(root, view_build='lazy')
+    db.save({'a': 1})
+    db.define('broken', lambda o: (o['b'], None))
+    with pytest.raises(KeyError):
+        list(db.view('broken'))
+    with pytest.raises(KeyError):
+        list(db.view('broken'))
+
+
+def test_unknown_build(root):
+    with pytest.raises(ValueError):
+        jsondb.Database(root, view_build='sometime')
+    db = jsondb.Database(root)
+    with pytest.raises(ValueError):
+        db.define('by_a', lambda o: (o['a'], None), build='sometime')
@@ -0,0 +1,97 @@
+import pytest
+import tempfile
+from lindh import jsondb
+from lindh.jsondb import csv
+
+
+@pytest.fixture(scope='function')
+def db():
+    db = jsondb.Database(root=tempfile.mkdtemp(prefix='jsondb-'))
+    yield db
+    db.destroy()
+
+
+def test_save_many(db):
+    db.define('b_by_a', lambda o: (o['a'], o['b']))
+    r = db.save_many([{'a': 2, 'b': 22}, {'a': 3, 'b': 33}, {'a': 1, 'b': 11}])
+    assert r == [
+        {'id': 0, 'rev': 0, 'ok': True},
+        {'id': 1, 'rev': 0, 'ok': True},
+        {'id': 2, 'rev': 0, 'ok': True},
+    ]
+    assert db.get(1) == {'_id': 1, '_rev': 0, 'a': 3, 'b': 33}
+    assert list(db.view('b_by_a')) == [
+        {'id': 2, 'key': 1, 'value': 11},
+        {'id': 0, 'key': 2, 'value': 22},
+        {'id': 1, 'key': 3, 'value': 33},
+    ]
+
+
+def test_save_many_updates_existing_rows(db):
+    db.define('b_by_a', lambda o: (o['a'], o['b']))
+    o = db.save({'a': 2, 'b': 22})
+    o['a'] = 4
+    db.save_many([o, {'a': 3, 'b': 33}])
+    assert list(db.view('b_by_a')) == [
+        {'id': 1, 'key': 3, 'value': 33},
+        {'id': 0, 'key': 4, 'value': 22},
+    ]
+
+
+def test_save_many_conflicts(db):
+    db.define('b_by_a', lambda o: (o['a'], o['b']))
+    o = db.save({'a': 1, 'b': 11})
+    stale = dict(o)
+    o['b'] = 111
+    r = db.save_many([o, stale, {'_id': 'x', 'a': 2, 'b': 22}])
+    assert r == [
+        {'id': 0, 'rev': 1, 'ok': True},
+        {'id': 0, 'error': 'conflict'},
+        {'id': 'x', 'rev': 0, 'ok': True},
+    ]
+    assert list(db.view('b_by_a')) == [
+        {'id': 0, 'key': 1, 'value': 111},
+        {'id': 'x', 'key': 2, 'value': 22},
+    ]
+
+
+def test_save_many_same_document_twice(db):
+    db.define('b_by_a', lambda o: (o['a'], o['b']))
+    first = {'_id': 'x', 'a': 1, 'b': 11}
+    second = {'_id': 'x', '_rev': 0, 'a': 2, 'b': 22}
+    r = db.save_many([first, second])
+    assert [row['rev'] for row in r] == [0, 1]
+    assert list(db.view('b_by_a')) == [{'id': 'x', 'key': 2, 'value': 22}]
+
+
+def test_delete_many(db):
+    db.define('b_by_a', lambda o: (o['a'], o['b']))
+    db.save_many([{'a': 2, 'b': 22}, {'a': 3, 'b': 33}, {'a': 1, 'b': 11}])
+    r = db.delete_many([0, 2, 5])
+    assert r == [
+        {'id': 0, 'ok': True},
+        {'id': 2, 'ok': True},
+        {'id': 5, 'error': 'not_found'},
+    ]
+    assert not db.has(0)
+    assert list(db.view('b_by_a')) == [{'id': 1, 'key': 3, 'value': 33}]
+
+
+def test_delete_many_twice(db):
+    db.define('b_by_a', lambda o: (o['a'], o['b']))
+    db.save_many([{'a': 2, 'b': 22}, {'a': 3, 'b': 33}])
+    r = db.delete_many([1, 1])
+    assert r == [
+        {'id': 1, 'ok': True},
+        {'id': 1, 'error': 'not_found'},
+    ]
+    assert not db.has(1)
+    assert [row['id'] for row in db.changes(since=2)] == [1]
+    assert list(db.view('b_by_a')) == [{'id': 0, 'key': 2, 'value': 22}]
+
+
+def test_save_many_from_csv(db):
+    db.define('c_by_a', lambda o: (o['a'], o['c']))
+    with csv.open('tests/data/simple.csv', types=(str, int, int)) as f:
+        db.save_many(f)
+    assert [row['value'] for row in db.view('c_by_a')] == [11, 22, 33]
@@ -0,0 +1,99 @@
+import pytest
+import tempfile
+from lindh import jsondb
+from lindh.jsondb.cache import LRUCache
+
+
+@pytest.fixture(scope='function')
+def db():
+    db = jsondb.Database(root=tempfile.mkdtemp(prefix='jsondb-'), cache_size=2)
+    yield db
+    db.destroy()
+
+
+def test_lru_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get('a')
+    cache.put('c', 3)
+    assert 'a' in cache
+    assert 'b' not in cache
+    with pytest.raises(KeyError):
+        cache.get('b')
+    assert cache.info()[:3] == (1, 1, 2)
+
+
+def test_lru_by_bytes():
+    cache = LRUCache(maxbytes=1000)
+    cache.put('a', {'x': 'a' * 300})
+    cache.put('b', {'x': 'b' * 300})
+    cache.put('c', {'x': 'c' * 300})
+    assert 'a' not in cache
+    assert 'c' in cache
+    assert cache.info().bytes <= 1000
+    cache.put('d', {'x': 'd' * 2000})
+    assert 'd' not in cache
+
+
+def test_get_is_served_from_cache(db):
+    db.save({'a': 1})
+    db.get(0)
+    db.get(0)
+    info = db.cache_info()
+    assert info.hits == 2
+    # looking for a current revision of the new document
+    assert info.misses == 1
+
+
+def test_cached_document_is_a_copy(db):
+    db.save({'a': [1]})
+    o = db.get(0)
+    o['a'].append(2)
+    assert db.get(0) == {'_id': 0, '_rev': 0, 'a': [1]}
+
+
+def test_cache_follows_save_and_delete(db):
+    o = db.save({'a': 1})
+    o['a'] = 2
+    db.save(o)
+    assert db.get(0)['a'] == 2
+    db.delete(0)
+    assert not db.has(0)
+    with pytest.raises(KeyError):
+        db.get(0)
+
+
+def test_conflict_check_uses_cache(db):
+    o = db.save({'a': 1})
+    db.save(dict(o))
+    with pytest.raises(jsondb.Conflict):
+        db.save(o)
+    assert db.cache_info()[:2] == (2, 1)
+
+
+def test_include_docs_from_cache():
+    db = jsondb.Database(root=tempfile.mkdtemp(prefix='jsondb-'), cache_size=10)
+    db.define('by_a', lambda o: (o['a'], None))
+    db.save_many([{'a': 1}, {'a': 2}, {'a': 3}])
+    misses = db.cache_info().misses
+    r = list(db.view('by_a', include_docs=True))
+    assert [v['doc']['a'] for v in r] == [1, 2, 3]
+    assert db.cache_info().misses == misses
+    db.destroy()
+
+
+def test_no_cache_by_default():
+    db = jsondb.Database(root=tempfile.mkdtemp(prefix='jsondb-'))
+    assert db.cache_info() is None
+    db.destroy()
+
+
+def test_no_copy_without_cache(monkeypatch):
+    db = jsondb.Database(root=tempfile.mkdtemp(prefix='jsondb-'))
+    db.save({'a': {'b': 1}})
+    monkeypatch.setattr(jsondb, 'copy', lambda o: pytest.fail('copied'))
+    o = db.get(0)
+    o['a']['b'] = 2
+    assert db.get(0)['a']['b'] == 1
+    db.destroy()
@@ -0,0 +1,76 @@
+import asyncio
+import pytest
+import tempfile
+import threading
+import time
+from lindh import jsondb
+from lindh.jsondb.aio import AsyncDatabase
+
+
+@pytest.fixture(scope='function')
+def db():
+    db = jsondb.Database(tempfile.mkdtemp(prefix='jsondb-'))
+    yield db
+    db.destroy()
+
+
+def test_changes_since(db):
+    assert list(db.changes()) == []
+    assert db.update_seq == 0
+    o = db.save({'a': 1})
+    db.save({'a': 2})
+    o['a'] = 3
+    db.save(o)
+    db.delete(1)
+    assert db.update_seq == 4
+    assert list(db.changes()) == [
+        {'seq': 1, 'id': 0},
+        {'seq': 2, 'id': 1},
+        {'seq': 3, 'id': 0},
+        {'seq': 4, 'id': 1, 'deleted': True},
+    ]
+    assert [c['seq'] for c in db.changes(since=2)] == [3, 4]
+    assert [c['seq'] for c in db.changes(since=1, limit=2)] == [2, 3]
+    assert list(db.changes(since=4)) == []
+
+
+def test_changes_with_docs(db):
+    db.save_many([{'a': 1}, {'a': 2}])
+    db.delete(0)
+    changes = list(db.changes(include_docs=True))
+    assert [c['doc'] for c in changes] == [
+        None, {'_id': 1, '_rev': 0, 'a': 2}, None]
+
+
+def test_changes_since_in_long_log(db):
+    db.save_many([{'a': i} for i in range(300)])
+    assert [c['seq'] for c in db.changes(since=177, limit=3)] == [178, 179, 180]
+    assert len(list(db.changes(since=290))) == 10
+    assert [c['seq'] for c in db.changes(since=0, limit=1)] == [1]
+
+
+def test_longpoll(db):
+    db.save({'a': 1})
+    started = time.monotonic()
+    assert list(db.changes(since=1, feed='longpoll', timeout=0.05)) == []
+    assert time.monotonic() - started >= 0.05
+
+    thread = threading.Timer(0.05, db.save, args=({'a': 2},))
+    thread.start()
+    assert [c['id'] for c in db.changes(since=1, feed='longpoll', timeout=5)] == [1]
+    thread.join()
+
+    with pytest.raises(ValueError):
+        list(db.changes(feed='continuous'))
+
+
+def test_async_changes(db):
+    adb = AsyncDatabase(db)
+
+    async def go():
+        waiting = asyncio.ensure_future(adb.wait_for_change(0, timeout=5))
+        await adb.save({'a': 1})
+        assert await waiting == 1
+        assert [c['id'] async for c in adb.changes(include_docs=True)] == [0]
+        await adb.close()
+    asyncio.run(go())
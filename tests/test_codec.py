@@ -0,0 +1,76 @@
+import os
+import pytest
+import tempfile
+from lindh import jsondb
+from lindh.jsondb import codec
+
+
+@pytest.fixture(scope='function')
+def root():
+    root = tempfile.mkdtemp(prefix='jsondb-')
+    yield root
+    jsondb.Database(root).destroy()
+
+
+def object_files(root):
+    for r, ds, fs in os.walk(os.path.join(root, 'objects')):
+        for f in fs:
+            with open(os.path.join(r, f), 'rb') as f:
+                yield f.read()
+
+
+DOC = {'a': [1, 2.5, None, True], 'b': {'c': 'åäö\x00'}, 'd': ''}
+
+
+@pytest.mark.parametrize('name', codec.CODECS)
+def test_round_trip(name):
+    if name == 'msgpack' and codec.msgpack is None:
+        pytest.skip('msgpack is not installed')
+    assert codec.decode(codec.encoder(name)(DOC)) == DOC
+
+
+def test_unknown_codec(root):
+    with pytest.raises(ValueError):
+        jsondb.Database(root, codec='yaml')
+
+
+def test_codec_is_recorded(root):
+    db = jsondb.Database(root, codec='json-zlib')
+    db.save({'a': 1})
+    db = jsondb.Database(root)
+    db.save({'a': 2})
+    assert all(data.startswith(b'\x00Z') for data in object_files(root))
+    assert [db.get(id)['a'] for id in (0, 1)] == [1, 2]
+
+
+def test_reads_legacy_and_migrates(root):
+    db = jsondb.Database(root, codec='json-pretty')
+    db.define('by_a', lambda o: (o['a'], None))
+    db.save_many([{'a': 1}, {'a': 2}])
+    assert all(data.startswith(b'{\n  ') for data in object_files(root))
+
+    db = jsondb.Database(root, codec='json-zlib')
+    db.define('by_a', lambda o: (o['a'], None))
+    db.save({'a': 3})
+    assert sorted(data[:2] for data in object_files(root)) == [b'\x00Z', b'{\n', b'{\n']
+    assert [v['key'] for v in db.view('by_a')] == [1, 2, 3]
+
+    db.migrate('json')
+    assert all(data.startswith(b'{"') for data in object_files(root))
+    db.reindex()
+    assert [v['key'] for v in db.view('by_a')] == [1, 2, 3]
+    assert jsondb.Database(root)._codec == 'json'
+
+
+def test_log_storage_codec():
+    root = tempfile.mkdtemp(prefix='jsondb-')
+    db = jsondb.Database(root, storage=jsondb.LogStorage, codec='json-zlib')
+    try:
+        db.save({'a': 'x' * 1000})
+        assert db.get(0)['a'] == 'x' * 1000
+        assert os.path.getsize(db._storage._segment_path(1)) < 200
+        db.migrate('json')
+        db = jsondb.Database(root, storage=jsondb.LogStorage)
+        assert db.get(0)['a'] == 'x' * 1000
+    finally:
+        db.destroy()
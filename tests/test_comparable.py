@@ -1,5 +1,5 @@
 import pytest
-from lindh.jsondb import Comparable
+from lindh.jsondb import Comparable, collate
 
 
 @pytest.mark.parametrize('a,b,expected', [
@@ -112,3 +112,44 @@ def test_greater_or_equal(a, b, expected):
     a = Comparable(a)
     b = Comparable(b)
     assert (a >= b) is expected
+
+
+@pytest.mark.parametrize('a,b', [
+    ('a', 'b'),
+    (None, 'a'),
+    ('a', any),
+    (1, 2),
+    (None, 0),
+    (0, any),
+    (1, 'a'),
+    ('1', 'a'),
+    (-2.5, -1),
+    (-1, 0),
+    (0, 0.5),
+    (2, 10),
+    (True, 2),
+    ('a', 'a\x00'),
+    ('a', 'ab'),
+    ('b\x00', 'bz'),
+    ('z', ((1,),)),
+    ((1,), ('a',)),
+    ((2,), (2, 1)),
+    ((2, 1), (2, 'a')),
+    ((2, any), (3,)),
+    ((1, ('a',)), (1, ('a', None))),
+    ((1, 'a'), (1, {'x': 1})),
+])
+def test_collate_less_than(a, b):
+    assert collate(a) < collate(b)
+    assert not collate(b) < collate(a)
+
+
+@pytest.mark.parametrize('a,b', [
+    (1, 1.0),
+    (0, -0.0),
+    (True, 1),
+    ('a', ('a',)),
+    ((1, (2,)), (1, [2])),
+])
+def test_collate_equal(a, b):
+    assert collate(a) == collate(b)
@@ -0,0 +1,106 @@
+import random
+import pytest
+import tempfile
+from lindh import jsondb
+
+
+@pytest.fixture(scope='function')
+def root():
+    root = tempfile.mkdtemp(prefix='jsondb-')
+    yield root
+    jsondb.Database(root).destroy()
+
+
+def by_a(o):
+    for a in o['a']:
+        yield a, o['_id']
+
+
+def count(keys, values, rereduce):
+    return sum(values) if rereduce else len(values)
+
+
+QUERIES = [
+    {},
+    {'key': 3},
+    {'startkey': 2, 'endkey': 5},
+    {'startkey': 4, 'startkey_docid': 10, 'limit': 7},
+    {'skip': 5, 'limit': 10},
+    {'endkey': 1, 'endkey_docid': 20},
+    {'startkey': 'x'},
+]
+
+
+def check(db):
+    for query in QUERIES:
+        assert list(db.view('frozen', **query)) == list(db.view('live', **query)), query
+    assert list(db.view('frozen_count', group=True)) == list(db.view('live_count', group=True))
+    assert list(db.view('frozen_count')) == list(db.view('live_count'))
+
+
+def define(db):
+    db.define('live', by_a)
+    db.define('frozen', by_a, version='frozen')
+    db.define('live_count', by_a, count)
+    db.define('frozen_count', by_a, count, version='frozen-count')
+
+
+def test_frozen_view_with_changes(root):
+    rnd = random.Random(3)
+    db = jsondb.Database(root)
+    define(db)
+    db.save_many([{'a': [rnd.randrange(8) for _ in range(rnd.randrange(3))]} for _ in range(60)])
+    db.freeze('frozen')
+    db.freeze('frozen_count')
+    assert isinstance(db._view_data['frozen'], jsondb._FrozenView)
+    check(db)
+
+    for round in range(4):
+        for _ in range(15):
+            id = rnd.randrange(70)
+            if rnd.random() < 0.3:
+                if db.has(id):
+                    db.delete(id)
+            else:
+                o = db.get(id) if db.has(id) else {'_id': id}
+                o['a'] = [rnd.randrange(8) for _ in range(rnd.randrange(3))]
+                db.save(o)
+        check(db)
+        if round == 1:
+            db.freeze('frozen')
+            check(db)
+
+
+def test_frozen_view_is_loaded(root):
+    db = jsondb.Database(root)
+    define(db)
+    db.save_many([{'a': [i % 5]} for i in range(20)])
+    db.freeze('frozen')
+    db.freeze('frozen_count')
+    db.save({'_id': 3, '_rev': 0, 'a': [9]})
+    db.delete(4)
+    db.checkpoint()
+
+    db = jsondb.Database(root)
+    define(db)
+    assert isinstance(db._view_data['frozen'], jsondb._FrozenView)
+    assert len(db._id_view_cache['frozen']) == 1
+    check(db)
+    assert list(db.view('frozen', key=9)) == [{'id': 3, 'key': 9, 'value': 3}]
+
+    db = jsondb.Database(root)
+    db.define('frozen', lambda o: (o['a'], None), version='changed')
+    assert not isinstance(db._view_data['frozen'], jsondb._FrozenView)
+
+
+def test_snapshot_is_not_changed_by_writes(root):
+    db = jsondb.Database(root)
+    db.define('frozen', by_a)
+    db.save_many([{'a': [i]} for i in range(5)])
+    db.freeze('frozen')
+    rows = db.view('frozen')
+    assert next(rows)['key'] == 0
+    db.delete(2)
+    db.save({'a': [1]})
+    assert [v['key'] for v in rows] == [1, 2, 3, 4]
+    assert [v['key'] for v in db.view('frozen')] == [0, 1, 1, 3, 4]
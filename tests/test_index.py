@@ -0,0 +1,119 @@
+import pytest
+import pickle
+import tempfile
+from lindh import jsondb
+from lindh.jsondb.index import FieldIndex
+
+
+@pytest.fixture(scope='function')
+def db():
+    db = jsondb.Database(tempfile.mkdtemp(prefix='jsondb-'), metrics=True)
+    db.save_many([
+        {'brand': 'Volvo', 'model': 'V70', 'engine': {'power': 140}},
+        {'brand': 'Saab', 'model': '900', 'engine': {'power': 185}},
+        {'brand': 'Volvo', 'model': '240', 'engine': {'power': 116}},
+        {'brand': 'Ford', 'engine': None},
+    ])
+    yield db
+    db.destroy()
+
+
+def keys(db, name, **kwargs):
+    return [(v['id'], v['key']) for v in db.view(name, **kwargs)]
+
+
+def map_count(db, name):
+    return db.metrics.snapshot()['timers'].get('map_seconds{view="%s"}' % name, {}).get('count', 0)
+
+
+def test_create_index(db):
+    assert db.create_index('brand') == 'by_brand'
+    assert keys(db, 'by_brand') == [(3, 'Ford'), (1, 'Saab'), (0, 'Volvo'), (2, 'Volvo')]
+    assert db.create_index('brand', 'model') == 'by_brand_model'
+    assert keys(db, 'by_brand_model', startkey=('Volvo',), endkey=('Volvo', any)) == \
+        [(2, ('Volvo', '240')), (0, ('Volvo', 'V70'))]
+    assert db.create_index('engine.power', name='by_power') == 'by_power'
+    assert keys(db, 'by_power', startkey=120) == [(0, 140), (1, 185)]
+    assert [v['value'] for v in db.view('by_brand')] == [None] * 4
+
+
+def test_index_follows_writes(db):
+    db.create_index('brand', 'model')
+    o = db.get(3)
+    o['model'] = 'Escort'
+    db.save(o)
+    db.delete(0)
+    db.save({'brand': 'Audi', 'model': 'A4'})
+    assert keys(db, 'by_brand_model') == [
+        (4, ('Audi', 'A4')), (3, ('Ford', 'Escort')), (1, ('Saab', '900')), (2, ('Volvo', '240'))]
+
+
+def test_unchanged_fields_skip_index(db):
+    db.create_index('brand')
+    db.define('all', lambda o: (o['_id'], None))
+    before = map_count(db, 'by_brand'), map_count(db, 'all')
+
+    o = db.get(0)
+    o['model'] = 'V90'
+    db.save(o)
+    db.save_many([dict(db.get(1), model='9000'), dict(db.get(2), model='740')])
+    assert map_count(db, 'by_brand') == before[0]
+    assert map_count(db, 'all') == before[1] + 3
+    assert keys(db, 'by_brand') == [(3, 'Ford'), (1, 'Saab'), (0, 'Volvo'), (2, 'Volvo')]
+
+    o = db.get(0)
+    o['brand'] = 'Saab'
+    db.save(o)
+    db.save_many([dict(db.get(2), brand='Audi')])
+    assert map_count(db, 'by_brand') == before[0] + 2
+    assert keys(db, 'by_brand') == [(2, 'Audi'), (3, 'Ford'), (0, 'Saab'), (1, 'Saab')]
+
+
+def test_same_value_of_another_type(db):
+    db.create_index('engine.power', name='by_power')
+    o = db.get(0)
+    o['engine']['power'] = 140.0
+    db.save(o)
+    assert keys(db, 'by_power', key=140) == [(0, 140.0)]
+    assert isinstance(next(db.view('by_power', key=140))['key'], float)
+
+
+def test_batch_saving_twice(db):
+    db.create_index('brand')
+    o = db.get(0)
+    o['brand'] = 'Saab'
+    db.save_many([o, dict(o, brand='Volvo', _rev=o['_rev'] + 1)])
+    assert keys(db, 'by_brand', key='Volvo') == [(0, 'Volvo'), (2, 'Volvo')]
+    db.save_many([dict(db.get(0), brand='Saab'), dict(db.get(1), brand='Volvo')])
+    assert keys(db, 'by_brand') == [(3, 'Ford'), (0, 'Saab'), (1, 'Volvo'), (2, 'Volvo')]
+
+
+def test_indexes_are_kept(db):
+    db.create_index('brand')
+    db.create_index('model')
+    db.drop_index('by_model')
+    db.save({'brand': 'Opel'})
+    db = jsondb.Database(db.root)
+    assert keys(db, 'by_brand', key='Opel') == [(4, 'Opel')]
+    with pytest.raises(KeyError):
+        list(db.view('by_model'))
+    with pytest.raises(KeyError):
+        db.drop_index('by_model')
+
+
+def test_parallel_reindex(db):
+    db.create_index('brand', 'model')
+    rows = keys(db, 'by_brand_model')
+    db.reindex(processes=2)
+    assert keys(db, 'by_brand_model') == rows
+
+
+def test_field_index():
+    index = FieldIndex(['a.b', 'c'])
+    assert index({'a': {'b': 1}, 'c': 2}) == ((1, 2), None)
+    assert index({'a': {'b': 1}}) is None
+    assert index({'a': 'x', 'c': 2}) is None
+    assert pickle.loads(pickle.dumps(index)) == index
+    assert FieldIndex(['a'])({'a': None}) == (None, None)
+    with pytest.raises(ValueError):
+        FieldIndex([])
@@ -0,0 +1,111 @@
+import pytest
+import tempfile
+import threading
+from lindh import jsondb
+from lindh.jsondb.lock import ReadWriteLock
+
+
+@pytest.fixture(scope='function')
+def db():
+    db = jsondb.Database(root=tempfile.mkdtemp(prefix='jsondb-'))
+    yield db
+    db.destroy()
+
+
+def test_readers_share_the_lock():
+    lock = ReadWriteLock()
+    inside = threading.Barrier(3, timeout=5)
+
+    def reader():
+        with lock.read():
+            inside.wait()
+
+    threads = [threading.Thread(target=reader) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    inside.wait()
+    for thread in threads:
+        thread.join()
+
+
+def test_writer_waits_for_readers():
+    lock = ReadWriteLock()
+    events = []
+    lock.acquire_read()
+
+    def writer():
+        with lock:
+            events.append('write')
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    thread.join(0.1)
+    assert events == []
+    events.append('read done')
+    lock.release_read()
+    thread.join()
+    assert events == ['read done', 'write']
+
+
+def test_write_while_iterating_view(db):
+    db.define('by_a', lambda o: (o['a'], None))
+    db.save_many([{'a': a} for a in range(5)])
+    rows = db.view('by_a')
+    assert next(rows)['key'] == 0
+    db.save({'a': 10})
+    db.delete(3)
+    assert [v['key'] for v in rows] == [1, 2, 3, 4]
+    assert [v['key'] for v in db.view('by_a')] == [0, 1, 2, 4, 10]
+
+
+def test_write_from_other_thread_while_iterating_view(db):
+    db.define('by_a', lambda o: (o['a'], None))
+    db.save_many([{'a': a} for a in range(5)])
+    rows = db.view('by_a', include_docs=True)
+    next(rows)
+    thread = threading.Thread(target=db.delete, args=(2,))
+    thread.start()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert [v['doc'] for v in rows][1] is None
+
+
+def test_stale_reduction_is_not_cached(db):
+    db.define('count', lambda o: (o['a'], 1),
+              lambda keys, values, rereduce: sum(values))
+    db.save_many([{'a': 1}, {'a': 1}, {'a': 2}])
+    rows = db.view('count', group=True)
+    assert next(rows) == {'key': 1, 'value': 2}
+    db.save({'a': 2})
+    assert list(rows) == [{'key': 2, 'value': 1}]
+    assert list(db.view('count', group=True)) == [{'key': 1, 'value': 2}, {'key': 2, 'value': 2}]
+
+
+def test_busy_writer_does_not_starve_others(db):
+    db.save({'a': 0})
+    stop = threading.Event()
+    done = {'get': 0, 'define': 0}
+
+    def writer():
+        while not stop.is_set():
+            db.save({'a': 1})
+
+    def reader():
+        while not stop.is_set():
+            db.get(0)
+            done['get'] += 1
+
+    def definer():
+        while not stop.is_set():
+            db.define('by_a', lambda o: (o['a'], None))
+            done['define'] += 1
+
+    threads = [threading.Thread(target=fn) for fn in (writer, reader, definer)]
+    for thread in threads:
+        thread.start()
+    stop.wait(1)
+    stop.set()
+    for thread in threads:
+        thread.join(10)
+    assert done['get'] > 10
+    assert done['define'] > 10
@@ -0,0 +1,91 @@
+import os
+import pytest
+import tempfile
+from lindh import jsondb
+from lindh.jsondb.metrics import Metrics, statsd_sink
+
+
+@pytest.fixture(scope='function')
+def db():
+    db = jsondb.Database(tempfile.mkdtemp(prefix='jsondb-'), metrics=True)
+    yield db
+    db.destroy()
+
+
+def test_off_by_default():
+    db = jsondb.Database(tempfile.mkdtemp(prefix='jsondb-'))
+    try:
+        db.save({'a': 1})
+        assert not hasattr(db.metrics, 'snapshot')
+    finally:
+        db.destroy()
+
+
+def test_database_metrics(db):
+    db.define('by_a', lambda o: (o['a'], 1), lambda keys, values, rereduce: sum(values))
+    db.save_many([{'a': a} for a in range(10)])
+    db.get(3)
+    assert len(list(db.view('by_a', no_reduce=True, startkey=2, endkey=5))) == 4
+    assert list(db.view('by_a', group=True, limit=2)) == [
+        {'key': 0, 'value': 1}, {'key': 1, 'value': 1}]
+
+    snapshot = db.metrics.snapshot()
+    counters = snapshot['counters']
+    timers = snapshot['timers']
+    assert counters['view_rows_scanned{view="by_a"}'] == 4 + 10
+    assert counters['view_rows_returned{view="by_a"}'] == 4 + 2
+    assert counters['io_bytes{op="read"}'] > 0
+    assert counters['io_bytes{op="write"}'] > 0
+    assert timers['map_seconds{view="by_a"}']['count'] == 10
+    assert timers['reduce_seconds{view="by_a"}']['count'] == 2
+    assert timers['json_seconds{op="decode"}']['count'] >= 1
+    assert timers['lock_wait_seconds{mode="write"}']['count'] >= 2
+    assert timers['lock_wait_seconds{mode="read"}']['count'] >= 3
+
+
+def test_log_storage_metrics():
+    db = jsondb.Database(tempfile.mkdtemp(prefix='jsondb-'), storage=jsondb.LogStorage,
+                         metrics=True)
+    try:
+        db.save({'a': 1})
+        db.get(0)
+        timers = db.metrics.snapshot()['timers']
+        assert timers['io_seconds{op="write"}']['count'] == 1
+        assert timers['io_seconds{op="read"}']['count'] >= 1
+    finally:
+        db.destroy()
+
+
+def test_prometheus():
+    metrics = Metrics(buckets=(0.1, 1.0))
+    metrics.count('rows', 3, view='by "a"')
+    metrics.observe('map_seconds', 0.5, view='x')
+    metrics.observe('map_seconds', 2.0, view='x')
+    assert metrics.prometheus().splitlines() == [
+        'jsondb_rows_total{view="by \\"a\\""} 3',
+        'jsondb_map_seconds_bucket{view="x",le="0.1"} 0',
+        'jsondb_map_seconds_bucket{view="x",le="1.0"} 1',
+        'jsondb_map_seconds_bucket{view="x",le="+Inf"} 2',
+        'jsondb_map_seconds_sum{view="x"} 2.5',
+        'jsondb_map_seconds_count{view="x"} 2',
+    ]
+    path = os.path.join(tempfile.mkdtemp(prefix='jsondb-'), 'jsondb.prom')
+    metrics.write_prometheus(path)
+    with open(path) as f:
+        assert f.read() == metrics.prometheus()
+
+
+def test_sinks():
+    events = []
+    metrics = Metrics(sink=lambda *event: events.append(event))
+    with metrics.timer('lock_wait_seconds', mode='read'):
+        pass
+    metrics.count('io_bytes', 10, op='read')
+    assert [e[:2] for e in events] == [('time', 'lock_wait_seconds'), ('count', 'io_bytes')]
+    assert events[1] == ('count', 'io_bytes', 10, {'op': 'read'})
+
+    lines = []
+    metrics = Metrics(sink=statsd_sink(lines.append))
+    metrics.count('io_bytes', 10, op='read')
+    metrics.observe('map_seconds', 0.0125)
+    assert lines == [b'jsondb.io_bytes:10|c|#op:read\n', b'jsondb.map_seconds:12.500|ms\n']
@@ -0,0 +1,79 @@
+import os
+import pytest
+import tempfile
+import multiprocessing
+from lindh import jsondb
+
+
+@pytest.fixture(scope='function')
+def root():
+    root = tempfile.mkdtemp(prefix='jsondb-')
+    yield root
+    jsondb.Database(root).destroy()
+
+
+def by_a(o):
+    return o['a'], None
+
+
+def test_views_follow_other_process(root):
+    db1 = jsondb.Database(root, multiprocess=True)
+    db2 = jsondb.Database(root, multiprocess=True)
+    db1.define('by_a', by_a)
+    db2.define('by_a', by_a)
+    o = db1.save({'a': 1})
+    db1.save({'a': 2})
+    assert [v['key'] for v in db2.view('by_a')] == [1, 2]
+
+    o = db2.get(o['_id'])
+    o['a'] = 3
+    db2.save(o)
+    db2.delete(1)
+    assert [v['key'] for v in db1.view('by_a')] == [3]
+    assert not db1.has(1)
+    assert db1._update_seq == db2._update_seq == 4
+
+
+def test_define_after_other_process_wrote(root):
+    db1 = jsondb.Database(root, multiprocess=True)
+    db2 = jsondb.Database(root, multiprocess=True)
+    db1.define('by_a', by_a)
+    db2.save({'a': 5})
+    db1.sync()
+    db2.define('by_a', by_a)
+    assert [v['key'] for v in db1.view('by_a')] == [5]
+    assert [v['key'] for v in db2.view('by_a')] == [5]
+
+
+def test_clear_reaches_other_process(root):
+    db1 = jsondb.Database(root, multiprocess=True, cache_size=10)
+    db2 = jsondb.Database(root, multiprocess=True)
+    db1.define('by_a', by_a)
+    db2.define('by_a', by_a)
+    db1.save_many([{'a': n} for n in range(5)])
+    assert db1.get(0)['a'] == 0
+    db2.clear()
+    db2.save({'a': 7})
+    assert [v['key'] for v in db1.view('by_a', include_docs=True)] == [7]
+    assert not db1.has(0)
+    assert [change.get('clear') for change in db1.changes(since=5)] == [True, None]
+
+
+def test_multiprocess_needs_file_storage(root):
+    with pytest.raises(ValueError):
+        jsondb.Database(root, storage=jsondb.LogStorage, multiprocess=True)
+
+
+def _save_some(root):
+    db = jsondb.Database(root, multiprocess=True)
+    return [db.save({'a': n})['_id'] for n in range(25)]
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs fork')
+def test_ids_are_unique_across_processes(root):
+    db = jsondb.Database(root, multiprocess=True)
+    db.define('by_a', by_a)
+    with multiprocessing.get_context('fork').Pool(4) as pool:
+        ids = sum(pool.map(_save_some, [root] * 4), [])
+    assert sorted(ids) == list(range(100))
+    assert len(list(db.view('by_a'))) == 100
@@ -0,0 +1,187 @@
+import pytest
+import tempfile
+from lindh import jsondb
+
+
+@pytest.fixture(scope='function')
+def root():
+    db = jsondb.Database(root=tempfile.mkdtemp(prefix='jsondb-'))
+    yield db.root
+    db.destroy()
+
+
+class CountingMap:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, o):
+        self.calls += 1
+        return o['a'], o['b']
+
+
+def by_a(o):
+    return o['a'], o['b']
+
+
+def test_checkpoint_is_reloaded(root):
+    db = jsondb.Database(root)
+    db.define('b_by_a', by_a, version=1)
+    db.save({'a': 2, 'b': 22})
+    db.save({'a': 1, 'b': 11})
+    db.checkpoint()
+
+    db = jsondb.Database(root)
+    fn = CountingMap()
+    db.define('b_by_a', fn, version=1)
+    assert fn.calls == 0
+    assert list(db.view('b_by_a')) == [
+        {'id': 1, 'key': 1, 'value': 11},
+        {'id': 0, 'key': 2, 'value': 22},
+    ]
+
+
+def test_changes_after_checkpoint_are_remapped(root):
+    db = jsondb.Database(root)
+    db.define('b_by_a', by_a, version=1)
+    o = db.save({'a': 2, 'b': 22})
+    db.save({'a': 1, 'b': 11})
+    db.checkpoint()
+    db.save({'a': 3, 'b': 33})
+    o['b'] = 2222
+    db.save(o)
+    db.delete(1)
+
+    db = jsondb.Database(root)
+    fn = CountingMap()
+    db.define('b_by_a', fn, version=1)
+    assert fn.calls == 2
+    assert list(db.view('b_by_a')) == [
+        {'id': 0, 'key': 2, 'value': 2222},
+        {'id': 2, 'key': 3, 'value': 33},
+    ]
+
+
+def test_same_map_function_is_recognized(root):
+    db = jsondb.Database(root)
+    db.define('b_by_a', by_a)
+    db.save({'a': 2, 'b': 22})
+    db.checkpoint()
+
+    db = jsondb.Database(root)
+    db.define('b_by_a', by_a)
+    assert db._load_view('b_by_a', jsondb._fingerprint(by_a))
+
+
+def test_changed_map_function_reindexes(root):
+    db = jsondb.Database(root)
+    db.define('view', lambda o: (o['a'], None))
+    db.save({'a': 2, 'b': 22})
+    db.checkpoint()
+
+    db = jsondb.Database(root)
+    db.define('view', lambda o: (o['b'], None))
+    assert list(db.view('view')) == [{'id': 0, 'key': 22, 'value': None}]
+
+
+def test_update_seq_survives_restart(root):
+    db = jsondb.Database(root)
+    db.save({'a': 1})
+    db.save({'a': 2})
+    assert db._update_seq == 2
+    db = jsondb.Database(root)
+    assert db._update_seq == 2
+
+
+def test_define_many_scans_once(root, monkeypatch):
+    db = jsondb.Database(root)
+    db.save_many([{'a': 1, 'b': 2}, {'a': 3, 'b': 4}])
+    scans = []
+    scan = db._storage.scan
+    monkeypatch.setattr(db._storage, 'scan', lambda: scans.append(1) or scan())
+    db.define_many([
+        ('b_by_a', by_a),
+        ('a_by_b', lambda o: (o['b'], o['a'])),
+        ('sum_b', by_a, lambda keys, values, rereduce: sum(values)),
+    ])
+    assert len(scans) == 1
+    assert [v['key'] for v in db.view('a_by_b')] == [2, 4]
+    assert list(db.view('sum_b')) == [{'key': None, 'value': 6}]
+
+
+def test_redefine_unchanged_is_free(root):
+    db = jsondb.Database(root)
+    db.save({'a': 1, 'b': 2})
+    fn = CountingMap()
+    db.define('b_by_a', fn, version=1)
+    assert fn.calls == 1
+    db.define('b_by_a', fn, version=1, reduce_fn=lambda keys, values, rereduce: len(values))
+    assert fn.calls == 1
+    assert list(db.view('b_by_a')) == [{'key': None, 'value': 1}]
+    db.define('b_by_a', fn, version=2)
+    assert fn.calls == 2
+    assert list(db.view('b_by_a')) == [{'id': 0, 'key': 1, 'value': 2}]
+
+
+def make_map(normalize):
+    return lambda o: (normalize(o['a']), None)
+
+
+def make_normalize(suffix=''):
+    def normalize(value):
+        return str(value).lower() + suffix
+    return normalize
+
+
+class Normalizer:
+    def __call__(self, value):
+        return str(value).lower()
+
+
+def test_fingerprint_of_function_in_closure():
+    assert jsondb._fingerprint(make_map(make_normalize())) == \
+        jsondb._fingerprint(make_map(make_normalize()))
+    assert jsondb._fingerprint(make_map(make_normalize())) != \
+        jsondb._fingerprint(make_map(make_normalize('!')))
+    assert jsondb._fingerprint(make_map(str.lower)) != \
+        jsondb._fingerprint(make_map(make_normalize()))
+
+
+def test_fingerprint_of_object_in_closure(caplog):
+    unstable = []
+    assert jsondb._fingerprint(make_map(Normalizer()), unstable.append) == \
+        jsondb._fingerprint(make_map(Normalizer()), unstable.append)
+    assert len(unstable) == 2
+    db = jsondb.Database(tempfile.mkdtemp(prefix='jsondb-'))
+    db.define('by_a', make_map(Normalizer()))
+    assert 'version=' in caplog.text
+    db.destroy()
+
+
+def test_restart_after_close_maps_nothing(root):
+    db = jsondb.Database(root)
+    db.define('b_by_a', CountingMap(), version=1)
+    db.save_many([{'a': n, 'b': n} for n in range(50)])
+    db.close()
+    for _ in range(2):
+        db = jsondb.Database(root)
+        fn = CountingMap()
+        db.define('b_by_a', fn, version=1)
+        assert fn.calls == 0
+        assert len(list(db.view('b_by_a'))) == 50
+        db.close()
+
+
+def test_long_catch_up_is_saved(root, monkeypatch):
+    monkeypatch.setattr(jsondb, '_CATCH_UP_LIMIT', 10)
+    db = jsondb.Database(root)
+    db.define('b_by_a', CountingMap(), version=1)
+    db.save_many([{'a': n, 'b': n} for n in range(20)])
+    db = jsondb.Database(root)
+    fn = CountingMap()
+    db.define('b_by_a', fn, version=1)
+    assert fn.calls == 20
+    db = jsondb.Database(root)
+    fn = CountingMap()
+    db.define('b_by_a', fn, version=1, build='lazy')
+    assert len(list(db.view('b_by_a'))) == 20
+    assert fn.calls == 0
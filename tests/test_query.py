@@ -0,0 +1,68 @@
+import random
+import pytest
+import tempfile
+from lindh import jsondb
+
+
+@pytest.fixture(scope='function')
+def db():
+    db = jsondb.Database(tempfile.mkdtemp(prefix='jsondb-'))
+    db.define('by_brand', lambda o: (o['brand'], None))
+    db.define('by_year', lambda o: (o['year'], None))
+    db.define('by_tag', lambda o: ((tag, None) for tag in o['tags']))
+    rnd = random.Random(5)
+    db.save_many([{
+        'brand': rnd.choice(['Volvo', 'Saab', 'Ford']),
+        'year': rnd.randrange(1990, 2020),
+        'tags': rnd.sample(['red', 'blue', 'old', 'fast'], rnd.randrange(3)),
+    } for _ in range(200)])
+    yield db
+    db.destroy()
+
+
+def ids(db, test):
+    return {o['_id'] for o in (db.get(id) for id in range(200) if db.has(id)) if test(o)}
+
+
+def test_intersection(db):
+    r = list(db.query({'view': 'by_brand', 'key': 'Saab'},
+                      {'view': 'by_year', 'startkey': 2000, 'endkey': 2009},
+                      {'view': 'by_tag', 'keys': ['red', 'fast']}))
+    assert len(r) == len({v['id'] for v in r})
+    assert {v['id'] for v in r} == ids(db, lambda o: o['brand'] == 'Saab' and
+                                       2000 <= o['year'] <= 2009 and
+                                       {'red', 'fast'} & set(o['tags']))
+    assert list(db.query({'view': 'by_brand', 'key': 'Opel'},
+                         {'view': 'by_year', 'startkey': 2000})) == []
+
+
+def test_union(db):
+    r = list(db.query({'view': 'by_brand', 'key': 'Ford'},
+                      {'view': 'by_year', 'endkey': 1995}, union=True))
+    assert len(r) == len({v['id'] for v in r})
+    assert {v['id'] for v in r} == ids(db, lambda o: o['brand'] == 'Ford' or o['year'] <= 1995)
+
+
+def test_limit_and_docs(db):
+    r = list(db.query({'view': 'by_brand', 'key': 'Volvo'},
+                      {'view': 'by_tag', 'key': 'old'}, limit=3, include_docs=True))
+    assert len(r) == 3
+    assert all(v['doc']['brand'] == 'Volvo' and 'old' in v['doc']['tags'] for v in r)
+
+
+def test_follows_writes_and_frozen_views(db):
+    db.freeze('by_year')
+    o = db.get(7)
+    o['year'] = 1900
+    o['brand'] = 'Lada'
+    db.save(o)
+    db.delete(8)
+    r = list(db.query({'view': 'by_year', 'endkey': 1990}, {'view': 'by_brand', 'key': 'Lada'}))
+    assert r == [{'id': 7}]
+    r = list(db.query({'view': 'by_brand', 'startkey': 'A'}, {'view': 'by_year', 'startkey': 1990}))
+    assert {v['id'] for v in r} == ids(db, lambda o: o['year'] >= 1990) - {7}
+
+
+def test_needs_conditions(db):
+    with pytest.raises(ValueError):
+        list(db.query())
@@ -0,0 +1,116 @@
+import pytest
+import tempfile
+from lindh import jsondb
+
+
+@pytest.fixture(scope='function')
+def db():
+    db = jsondb.Database(root=tempfile.mkdtemp(prefix='jsondb-'))
+    yield db
+    db.destroy()
+
+
+class Sum:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, keys, values, rereduce):
+        self.calls.append((keys, list(values), rereduce))
+        return sum(values)
+
+
+@pytest.fixture(scope='function')
+def sales(db):
+    reduce_fn = Sum()
+    db.define('sales', lambda o: ((o['year'], o['month']), o['amount']), reduce_fn)
+    db.save({'year': 2019, 'month': 1, 'amount': 10})
+    db.save({'year': 2019, 'month': 1, 'amount': 5})
+    db.save({'year': 2019, 'month': 2, 'amount': 7})
+    db.save({'year': 2020, 'month': 1, 'amount': 1})
+    db.save({'year': 2020, 'month': 3, 'amount': 2})
+    return db, reduce_fn
+
+
+def test_reduce_without_group(sales):
+    db, reduce_fn = sales
+    assert list(db.view('sales')) == [{'key': None, 'value': 25}]
+    assert reduce_fn.calls[-1] == (None, [15, 7, 1, 2], True)
+
+
+def test_reduce_range_without_group(sales):
+    db, _ = sales
+    r = list(db.view('sales', startkey=(2019, 2), endkey=(2020, 1)))
+    assert r == [{'key': None, 'value': 8}]
+    assert list(db.view('sales', startkey=(2021,))) == []
+
+
+def test_group_level(sales):
+    db, _ = sales
+    assert list(db.view('sales', group_level=1)) == [
+        {'key': (2019,), 'value': 22},
+        {'key': (2020,), 'value': 3},
+    ]
+    assert list(db.view('sales', group_level=2, skip=1, limit=2)) == [
+        {'key': (2019, 2), 'value': 7},
+        {'key': (2020, 1), 'value': 1},
+    ]
+
+
+def test_reductions_are_cached(sales):
+    db, reduce_fn = sales
+    list(db.view('sales', group=True))
+    list(db.view('sales'))
+    calls = len(reduce_fn.calls)
+    assert list(db.view('sales', group=True))[0] == {'key': (2019, 1), 'value': 15}
+    assert list(db.view('sales')) == [{'key': None, 'value': 25}]
+    assert len(reduce_fn.calls) == calls
+
+
+def test_reductions_are_updated(sales):
+    db, reduce_fn = sales
+    list(db.view('sales', group=True))
+    list(db.view('sales'))
+    del reduce_fn.calls[:]
+
+    db.save({'year': 2019, 'month': 2, 'amount': 3})
+    assert list(db.view('sales')) == [{'key': None, 'value': 28}]
+    assert reduce_fn.calls == [
+        ([(2019, 2)], [7, 3], False),
+        (None, [15, 10, 1, 2], True),
+    ]
+
+    db.delete(3)
+    db.save_many([{'year': 2021, 'month': 1, 'amount': 100}])
+    assert list(db.view('sales', group=True)) == [
+        {'key': (2019, 1), 'value': 15},
+        {'key': (2019, 2), 'value': 10},
+        {'key': (2020, 3), 'value': 2},
+        {'key': (2021, 1), 'value': 100},
+    ]
+
+
+def test_partial_group_is_not_cached(db):
+    reduce_fn = Sum()
+    db.define('count', lambda o: (o['a'], 1), reduce_fn)
+    for a in [1, 1, 1, 2]:
+        db.save({'a': a})
+    r = list(db.view('count', startkey=1, startkey_docid=1, group=True))
+    assert r == [{'key': 1, 'value': 2}, {'key': 2, 'value': 1}]
+    assert list(db.view('count', group=True))[0] == {'key': 1, 'value': 3}
+
+
+def test_write_rereduces_one_block(db):
+    reduce_fn = Sum()
+    db.define('n', lambda o: ((o['n'] // 100, o['n']), 1), reduce_fn)
+    db.save_many([{'n': n} for n in range(1000)])
+    assert list(db.view('n')) == [{'key': None, 'value': 1000}]
+    del reduce_fn.calls[:]
+
+    db.save({'n': 500})
+    assert list(db.view('n')) == [{'key': None, 'value': 1001}]
+    assert list(db.view('n', startkey=(1, 150), endkey=(8, 849))) == [{'key': None, 'value': 701}]
+    assert list(db.view('n', group_level=1))[5] == {'key': (5,), 'value': 101}
+    # only the changed key and its block are reduced again, the rest
+    # comes from the values of the other blocks
+    assert len(reduce_fn.calls) < 40
+    assert max(len(values) for _, values, _ in reduce_fn.calls) <= 2 * jsondb._REDUCE_BLOCK
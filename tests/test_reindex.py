@@ -0,0 +1,69 @@
+import pytest
+import tempfile
+from lindh import jsondb
+
+
+@pytest.fixture(scope='function')
+def db():
+    db = jsondb.Database(tempfile.mkdtemp(prefix='jsondb-'))
+    yield db
+    db.destroy()
+
+
+def by_a(o):
+    return o['a'], o['_id']
+
+
+def by_tags(o):
+    for tag in o.get('tags', ()):
+        yield tag, None
+
+
+def rows(db, name):
+    return [(v['id'], v['key'], v['value']) for v in db.view(name)]
+
+
+def test_parallel_reindex_matches_serial(db):
+    db.save_many([{'a': i % 7, 'tags': ['t%i' % (i % 3)]} for i in range(300)])
+    db.define('by_a', by_a)
+    db.define('by_tags', by_tags)
+    expected = {name: rows(db, name) for name in ('by_a', 'by_tags')}
+
+    db.reindex(processes=3)
+    assert {name: rows(db, name) for name in ('by_a', 'by_tags')} == expected
+
+    o = db.get(1)
+    o['a'] = 100
+    o['tags'] = []
+    db.save(o)
+    assert rows(db, 'by_a')[-1] == (1, 100, 1)
+    assert [v['id'] for v in db.view('by_tags')].count(1) == 0
+
+
+def test_parallel_reindex_progress(db):
+    db.save_many([{'a': i} for i in range(50)])
+    db.define('by_a', by_a)
+    seen = []
+    db.reindex(processes=2, progress=seen.append)
+    assert seen == sorted(seen)
+    assert seen[-1] == 50
+
+
+def test_unpicklable_map_falls_back(db):
+    db.save_many([{'a': i} for i in range(5)])
+    db.define('lambda', lambda o: (o['a'], None))
+    seen = []
+    db.reindex(processes=2, progress=seen.append)
+    assert [v['key'] for v in db.view('lambda')] == [0, 1, 2, 3, 4]
+    assert seen == [5]
+
+
+def test_log_storage_falls_back():
+    db = jsondb.Database(tempfile.mkdtemp(prefix='jsondb-'), storage=jsondb.LogStorage,
+                         reindex_processes=2)
+    try:
+        db.save_many([{'a': i} for i in range(5)])
+        db.define('by_a', by_a)
+        assert [v['key'] for v in db.view('by_a')] == [0, 1, 2, 3, 4]
+    finally:
+        db.destroy()
@@ -0,0 +1,102 @@
+import os
+import pytest
+import tempfile
+import functools
+from lindh import jsondb
+from lindh.jsondb.storage import LogStorage
+
+
+@pytest.fixture(scope='function', params=[jsondb.FileStorage, jsondb.LogStorage])
+def db(request):
+    db = jsondb.Database(root=tempfile.mkdtemp(prefix='jsondb-'),
+                         storage=request.param)
+    yield db
+    db.destroy()
+
+
+@pytest.fixture(scope='function')
+def root():
+    root = tempfile.mkdtemp(prefix='jsondb-')
+    yield root
+    jsondb.Database(root).destroy()
+
+
+def test_save_get_delete(db):
+    o = db.save({'a': 1})
+    assert db.has(o['_id'])
+    assert db.get(o['_id']) == {'_id': 0, '_rev': 0, 'a': 1}
+    db.delete(o['_id'])
+    assert not db.has(o['_id'])
+    with pytest.raises(KeyError):
+        db.get(o['_id'])
+    with pytest.raises(KeyError):
+        db.delete(o['_id'])
+
+
+def test_conflict(db):
+    o = db.save({'a': 1})
+    db.save(dict(o))
+    with pytest.raises(jsondb.Conflict):
+        db.save(o)
+
+
+def test_reindex(db):
+    db.save({'a': 2, 'b': 22})
+    db.save({'a': 3, 'b': 33})
+    o = db.save({'a': 1, 'b': 11})
+    db.delete(o['_id'])
+    db.define('b_by_a', lambda o: (o['a'], o['b']))
+    assert list(db.view('b_by_a')) == [
+        {'id': 0, 'key': 2, 'value': 22},
+        {'id': 1, 'key': 3, 'value': 33},
+    ]
+
+
+def test_log_survives_restart(root):
+    db = jsondb.Database(root, storage=LogStorage)
+    db['a'] = {'x': 1}
+    db['b'] = {'x': 2}
+    o = db['a']
+    o['x'] = 3
+    db.save(o)
+    db.delete('b')
+    db._storage.close()
+
+    db = jsondb.Database(root, storage=LogStorage)
+    assert db['a'] == {'_id': 'a', '_rev': 1, 'x': 3}
+    assert not db.has('b')
+
+
+def test_log_drops_torn_record(root):
+    db = jsondb.Database(root, storage=LogStorage)
+    db['a'] = {'x': 1}
+    db['b'] = {'x': 2}
+    db._storage.close()
+    path = db._storage._segment_path(1)
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 3)
+
+    db = jsondb.Database(root, storage=LogStorage)
+    assert db['a'] == {'_id': 'a', '_rev': 0, 'x': 1}
+    assert not db.has('b')
+    db['b'] = {'x': 4}
+    db._storage.close()
+
+    db = jsondb.Database(root, storage=LogStorage)
+    assert db['b'] == {'_id': 'b', '_rev': 0, 'x': 4}
+
+
+def test_log_compaction(root):
+    storage = functools.partial(LogStorage, segment_size=256, background=False)
+    db = jsondb.Database(root, storage=storage)
+    for n in range(20):
+        db[n % 4] = {'n': n, '_rev': None if n < 4 else (n // 4) - 1}
+    db.delete(3)
+    db._storage.compact()
+    assert len(db._storage._segment_numbers()) <= 3
+    assert [db[n]['n'] for n in range(3)] == [16, 17, 18]
+    db._storage.close()
+
+    db = jsondb.Database(root, storage=storage)
+    assert [db[n]['n'] for n in range(3)] == [16, 17, 18]
+    assert not db.has(3)
@@ -0,0 +1,172 @@
+import os
+import time
+import pytest
+import tempfile
+import threading
+from lindh import jsondb
+from lindh.jsondb import wal
+
+
+@pytest.fixture(scope='function')
+def root():
+    root = tempfile.mkdtemp(prefix='jsondb-')
+    yield root
+    jsondb.Database(root).destroy()
+
+
+@pytest.mark.parametrize('durability', wal.DURABILITY)
+def test_save_and_delete(root, durability):
+    db = jsondb.Database(root, durability=durability)
+    o = db.save({'a': 1})
+    db.save_many([{'a': 2}, {'a': 3}])
+    db.delete(o['_id'])
+    db.delete_many([1])
+    assert not db.has(0)
+    assert db.get(2)['a'] == 3
+    assert list(db._wal.records()) == [
+        {'id': 0, 'doc': {'a': 1, '_id': 0, '_rev': 0}},
+        {'id': 1, 'doc': {'a': 2, '_id': 1, '_rev': 0}},
+        {'id': 2, 'doc': {'a': 3, '_id': 2, '_rev': 0}},
+        {'id': 0, 'deleted': True},
+        {'id': 1, 'deleted': True},
+    ]
+
+
+def test_bad_durability(root):
+    with pytest.raises(ValueError):
+        jsondb.Database(root, durability='sometimes')
+
+
+def test_replay_after_crash(root):
+    db = jsondb.Database(root, durability='group-commit')
+    db.save({'_id': 'gone', 'a': 0})
+    # as if the process died between logging and writing the documents
+    db._wal.append([
+        {'id': 'x', 'doc': {'_id': 'x', '_rev': 0, 'a': 1}},
+        {'id': ['t', 1], 'doc': {'_id': ['t', 1], '_rev': 0, 'a': 2}},
+        {'id': 'gone', 'deleted': True},
+    ])
+
+    db = jsondb.Database(root, durability='group-commit')
+    db.define('by_a', lambda o: (o['a'], None))
+    assert db.get('x') == {'_id': 'x', '_rev': 0, 'a': 1}
+    assert db.get(('t', 1))['a'] == 2
+    assert not db.has('gone')
+    assert [v['key'] for v in db.view('by_a')] == [1, 2]
+    assert list(db._wal.records()) == []
+
+
+def test_reopen_does_not_replay_written_documents(root):
+    db = jsondb.Database(root, durability='group-commit')
+    db.save_many([{'a': 1}, {'a': 2}])
+    db.save(db.get(0))
+    db.delete(1)
+    db = jsondb.Database(root, durability='group-commit')
+    assert db.update_seq == 4
+    assert list(db.changes(since=4)) == []
+    assert db.get(0)['_rev'] == 1
+    assert not db.has(1)
+
+
+def test_replay_keeps_last_record(root):
+    db = jsondb.Database(root, durability='group-commit')
+    db._wal.append([
+        {'id': 'x', 'doc': {'_id': 'x', '_rev': 0, 'a': 1}},
+        {'id': 'x', 'doc': {'_id': 'x', '_rev': 1, 'a': 2}},
+    ])
+    db = jsondb.Database(root, durability='group-commit')
+    assert db.get('x')['a'] == 2
+    assert [row['id'] for row in db.changes()] == ['x']
+
+
+def test_close_empties_log(root):
+    db = jsondb.Database(root, durability='fsync-per-write')
+    db.save({'a': 1})
+    db.close()
+    db.close()
+    assert os.path.getsize(os.path.join(root, 'wal')) == 0
+    db = jsondb.Database(root, durability='fsync-per-write')
+    assert db.get(0)['a'] == 1
+    assert db.update_seq == 1
+
+
+def test_replay_without_durability(root):
+    db = jsondb.Database(root, durability='os-buffered')
+    db._wal.append([{'id': 'x', 'doc': {'_id': 'x', '_rev': 0}}])
+    db = jsondb.Database(root)
+    assert db.has('x')
+    assert not os.path.exists(os.path.join(root, 'wal'))
+
+
+def test_torn_record_is_ignored(root):
+    db = jsondb.Database(root, durability='fsync-per-write')
+    db._wal.append([{'id': 'x', 'doc': {'_id': 'x', '_rev': 0}}])
+    with open(os.path.join(root, 'wal'), 'ab') as f:
+        f.write(b'0badc0de {"id": "y", "doc"')
+    db = jsondb.Database(root, durability='fsync-per-write')
+    assert db.has('x')
+    assert not db.has('y')
+
+
+def test_group_commit_shares_fsync(root, monkeypatch):
+    calls = []
+    fsync = os.fsync
+
+    def counting_fsync(fd):
+        calls.append(fd)
+        time.sleep(0.005)
+        fsync(fd)
+
+    monkeypatch.setattr(wal.os, 'fsync', counting_fsync)
+    db = jsondb.Database(root, durability='group-commit')
+    barrier = threading.Barrier(8)
+
+    def writer():
+        barrier.wait()
+        for n in range(20):
+            db.save({'n': n})
+
+    threads = [threading.Thread(target=writer) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert db._update_seq == 160
+    assert 0 < len(calls) < 80
+
+
+def test_save_many_logs_batch_once(root, monkeypatch):
+    db = jsondb.Database(root, durability='fsync-per-write')
+    calls = []
+    fsync = os.fsync
+
+    def counting_fsync(fd):
+        calls.append(fd)
+        fsync(fd)
+
+    monkeypatch.setattr(wal.os, 'fsync', counting_fsync)
+    o = db.save({'a': 0})
+    calls.clear()
+    r = db.save_many([dict(o, a=1), dict(o, a=2)] + [{'a': n} for n in range(100)])
+    assert len(calls) == 1
+    assert r[1] == {'id': 0, 'error': 'conflict'}
+    assert db.get(0)['a'] == 1
+    assert len(list(db._wal.records())) == 102
+
+
+def test_log_is_truncated_when_full(root):
+    db = jsondb.Database(root, durability='group-commit')
+    db._wal.size = 1000
+    for n in range(20):
+        db.save({'n': n})
+    assert db._wal._written - db._wal._base <= 1000
+    db = jsondb.Database(root, durability='group-commit')
+    assert db.get(19)['n'] == 19
+
+
+def test_no_temporary_files_left(root):
+    db = jsondb.Database(root)
+    db.save({'a': 1})
+    db.save(db.get(0))
+    for r, ds, fs in os.walk(os.path.join(root, 'objects')):
+        assert all(f.endswith('.json') for f in fs)